@@ -0,0 +1,233 @@
+"""Load test secure_image_view against async_secure_image_view under ASGI.
+
+Usage:
+    python benchmarks/bench_async_view.py [--images 20] [--requests 1000]
+        [--concurrency 100] [--storage-latency-ms 0]
+
+Requests are driven straight through Django's ASGIHandler (no server or
+sockets), so the numbers reflect how each view behaves on the event loop.
+Under ASGI the sync view runs through sync_to_async on a single
+thread-sensitive executor; the async view only leaves the loop for storage
+I/O. --storage-latency-ms adds a sleep to every storage open/size/mtime call
+to approximate a remote storage backend, which is where the difference shows.
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    _workdir = tempfile.mkdtemp(prefix="cryptpix-bench-")
+    settings.configure(
+        SECRET_KEY="cryptpix-benchmarks",
+        ALLOWED_HOSTS=["*"],
+        INSTALLED_APPS=[
+            "django.contrib.contenttypes",
+            "django.contrib.sessions",
+            "cryptpix",
+        ],
+        DATABASES={
+            "default": {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": os.path.join(_workdir, "bench.sqlite3"),
+            }
+        },
+        MIDDLEWARE=["django.contrib.sessions.middleware.SessionMiddleware"],
+        ROOT_URLCONF="cryptpix.urls",
+        MEDIA_ROOT=os.path.join(_workdir, "media"),
+        STORAGES={
+            "default": {"BACKEND": "__main__.LatencyStorage"},
+            "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        },
+        USE_TZ=True,
+        DEFAULT_AUTO_FIELD="django.db.models.BigAutoField",
+    )
+
+import django
+from django.core.files.storage import FileSystemStorage
+
+# Set from --storage-latency-ms before any request is made
+STORAGE_LATENCY = 0.0
+
+
+class LatencyStorage(FileSystemStorage):
+    """FileSystemStorage that sleeps before each read-side call."""
+
+    def _delay(self):
+        if STORAGE_LATENCY:
+            time.sleep(STORAGE_LATENCY)
+
+    def _open(self, name, mode="rb"):
+        self._delay()
+        return super()._open(name, mode)
+
+    def size(self, name):
+        self._delay()
+        return super().size(name)
+
+    def get_modified_time(self, name):
+        self._delay()
+        return super().get_modified_time(name)
+
+
+django.setup()
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.db import connection, models
+from django.contrib.sessions.backends.db import SessionStore
+from django.urls import reverse
+from PIL import Image
+
+from cryptpix.integrations.django import CryptPixModelMixin
+from cryptpix.utils import build_cryptpix_registry, get_image_ref, sign_image_token
+
+
+class BenchPhoto(CryptPixModelMixin):
+    image = models.ImageField(upload_to="bench")
+
+    class Meta:
+        app_label = "cryptpix"
+
+
+def setup_images(count):
+    call_command("migrate", verbosity=0)
+    with connection.schema_editor() as editor:
+        editor.create_model(BenchPhoto)
+    build_cryptpix_registry()
+
+    photos = []
+    for index in range(count):
+        image = Image.effect_mandelbrot((640, 480), (-2 + index * 0.01, -1.5, 1, 1.5), 100)
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, "JPEG")
+        photo = BenchPhoto(image=SimpleUploadedFile(f"bench{index}.jpg", buffer.getvalue()))
+        photo.save()
+        photos.append(photo)
+    return photos
+
+
+async def asgi_get(app, path, cookie):
+    """One GET through the ASGI app; returns (status, body bytes)."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"testserver"), (b"cookie", f"sessionid={cookie}".encode())],
+        "client": ("127.0.0.1", 0),
+        "server": ("testserver", 80),
+    }
+    done = asyncio.Event()
+    sent_request = False
+
+    async def receive():
+        nonlocal sent_request
+        if not sent_request:
+            sent_request = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    status, size = None, 0
+
+    async def send(message):
+        nonlocal status, size
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+            if not message.get("more_body"):
+                done.set()
+
+    await app(scope, receive, send)
+    done.set()
+    return status, size
+
+
+async def run_load(app, urls, cookie, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(index):
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            status, _ = await asgi_get(app, urls[index % len(urls)], cookie)
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index) for index in range(total)))
+    elapsed = time.perf_counter() - started
+    return elapsed, sorted(latencies), failures
+
+
+def main():
+    global STORAGE_LATENCY
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--storage-latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    # The sync view's FileResponse is drained through sync_to_async under ASGI
+    warnings.filterwarnings("ignore", message="StreamingHttpResponse must consume")
+
+    print(f"Generating {args.images} images ...")
+    photos = setup_images(args.images)
+    session = SessionStore()
+    session.create()
+
+    STORAGE_LATENCY = args.storage_latency_ms / 1000
+    app = ASGIHandler()
+    tokens = [
+        sign_image_token(f"{get_image_ref(photo)}_{layer}", session.session_key)
+        for photo in photos
+        for layer in (1, 2)
+    ]
+
+    print(
+        f"{args.requests} requests, concurrency {args.concurrency}, "
+        f"storage latency {args.storage_latency_ms:g} ms"
+    )
+    print(f"{'view':<28} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'failed':>7}")
+    for label, url_name in (
+        ("secure_image_view", "secure-image"),
+        ("async_secure_image_view", "secure-image-async"),
+    ):
+        urls = [reverse(url_name, args=[token]) for token in tokens]
+        # Warm the layer name cache so both views skip the database
+        asyncio.run(run_load(app, urls, session.session_key, len(urls), args.concurrency))
+        elapsed, latencies, failures = asyncio.run(
+            run_load(app, urls, session.session_key, args.requests, args.concurrency)
+        )
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(
+            f"{label:<28} {args.requests / elapsed:9.0f} "
+            f"{statistics.median(latencies) * 1000:9.1f} {p95 * 1000:9.1f} {failures:7d}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Benchmark the hue-rotation/invert distortion against the per-pixel reference.
+
+Usage:
+    python benchmarks/bench_distort.py [--sizes 1,12,24] [--repeat 3] [--skip-reference]
+
+Sizes are in megapixels (3:2 aspect ratio). The reference implementation is
+the original Python double loop; at 24 MP it takes a long time, so
+``--skip-reference`` is available for quick runs.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY="cryptpix-benchmarks")
+
+from PIL import Image
+
+from cryptpix.core import _rotate_hue_and_invert_reference, rotate_hue_and_invert
+
+
+def make_image(megapixels: float) -> Image.Image:
+    height = int((megapixels * 1_000_000 / 1.5) ** 0.5)
+    width = int(height * 1.5)
+    return Image.frombytes("RGB", (width, height), random.randbytes(width * height * 3))
+
+
+def best_of(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1,12,24", help="comma-separated megapixel sizes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--hue-rotation", type=int, default=97)
+    parser.add_argument("--skip-reference", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{'MP':>6} {'size':>11} {'vectorized':>12} {'reference':>12} {'speedup':>9}")
+    for mp in (float(s) for s in args.sizes.split(",")):
+        image = make_image(mp)
+        fast = best_of(lambda: rotate_hue_and_invert(image, args.hue_rotation), args.repeat)
+
+        if args.skip_reference:
+            print(f"{mp:>6g} {'%dx%d' % image.size:>11} {fast:>11.3f}s {'-':>12} {'-':>9}")
+            continue
+
+        slow = best_of(lambda: _rotate_hue_and_invert_reference(image, args.hue_rotation), 1)
+        same = (
+            rotate_hue_and_invert(image, args.hue_rotation).tobytes()
+            == _rotate_hue_and_invert_reference(image, args.hue_rotation).tobytes()
+        )
+        print(
+            f"{mp:>6g} {'%dx%d' % image.size:>11} {fast:>11.3f}s {slow:>11.3f}s "
+            f"{slow / fast:>8.0f}x{'' if same else '  OUTPUT MISMATCH'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Compare layer encoder settings: encode time and output size.
+
+Usage:
+    python benchmarks/bench_encoding.py [--image photo.jpg] [--megapixels 12] [--repeat 3]
+
+Without --image a synthetic photo-like image is generated. The image is
+distorted and split once; only the encode of both layers is timed.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SECRET_KEY="cryptpix-benchmarks")
+
+from PIL import Image, ImageFilter
+
+from cryptpix.core import (
+    LayerEncoding,
+    choose_tile_size,
+    crop_to_divisible,
+    distort_image,
+    encode_layer,
+    split_layers,
+)
+
+
+ENCODINGS = {
+    "png level 1": LayerEncoding(compress_level=1),
+    "png level 6 (default)": LayerEncoding(),
+    "png level 9": LayerEncoding(compress_level=9),
+    "png optimize": LayerEncoding(optimize=True),
+    "webp lossless method 0": LayerEncoding(format="WEBP", webp_method=0),
+    "webp lossless method 4": LayerEncoding(format="WEBP"),
+    "webp lossless method 6": LayerEncoding(format="WEBP", webp_method=6),
+    "png palette 256 (lossy)": LayerEncoding(quantize_colors=256),
+    "png palette 64 (lossy)": LayerEncoding(quantize_colors=64),
+}
+
+
+def synthetic_photo(megapixels: float) -> Image.Image:
+    height = int((megapixels * 1_000_000 / 1.5) ** 0.5)
+    width = int(height * 1.5)
+    base = Image.effect_mandelbrot((width, height), (-2.2, -1.2, 1.0, 1.2), 64)
+    noise = Image.effect_noise((width, height), 24)
+    return Image.merge(
+        "RGB", (base, noise, Image.linear_gradient("L").resize((width, height)))
+    ).filter(ImageFilter.SMOOTH)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--image", help="source image (default: synthetic)")
+    parser.add_argument("--megapixels", type=float, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    source = Image.open(args.image) if args.image else synthetic_photo(args.megapixels)
+    distorted, _ = distort_image(source, hue_rotation=97)
+    rgba = distorted.convert("RGBA")
+    block_size = choose_tile_size(*rgba.size)
+    layers = split_layers(crop_to_divisible(rgba, block_size), block_size)
+    raw_bytes = sum(len(layer.tobytes()) for layer in layers)
+
+    print(f"source {source.size[0]}x{source.size[1]}, tile {block_size}, raw layers {raw_bytes / 1e6:.1f} MB")
+    print(f"{'encoding':<26} {'time':>9} {'bytes':>12} {'ratio':>7}")
+    for name, encoding in ENCODINGS.items():
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            size = sum(len(encode_layer(layer, encoding).getvalue()) for layer in layers)
+            timings.append(time.perf_counter() - start)
+        print(f"{name:<26} {min(timings):>8.3f}s {size:>12,} {raw_bytes / size:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+"""Reproducible benchmark suite for the CryptPix pipeline and serving path.
+
+Usage:
+    python benchmarks/bench_suite.py [--quick] [--repeat 3] [--only core|django]
+        [--output results.json] [--compare baseline.json]
+
+Core stages (per synthetic image):
+    distort        distort_image (hue rotation + invert)
+    split          crop_to_divisible + split_layers (pixel work only)
+    encode_png     encode_layer for both layers with the default PNG encoding
+    process_split  process_and_split_image (crop, split and encode)
+    build_layers   build_cryptpix_layers with distortion and split
+    build_stream   the same with a 16 MB memory_budget (cryptpix.streaming)
+
+Django stages (test client against an in-process sqlite database):
+    view_cached    secure_image_view with the layer name cache warm
+    view_uncached  secure_image_view with the name cache cleared per request
+    tag_image      {% cryptpix_image %} in a loop over the photos
+    tag_gallery    {% cryptpix_gallery %} over the same photos
+
+Images are deterministic and cover each choose_tile_size bucket (max side
+<= 768, <= 1536, > 1536) in landscape, portrait, square and panorama
+shapes. Every core stage reports the best wall time of --repeat runs, MP/s,
+the tracemalloc peak and the sampled peak RSS growth from a separate run.
+tracemalloc only sees Python allocations (bytes objects, BytesIO buffers);
+Pillow's pixel buffers are allocated in C and only show up in the RSS
+figure, which is sampled from /proc and therefore Linux-only. RSS growth
+is measured from the current resident size, so memory the allocator kept
+from an earlier stage is reused without showing up again.
+
+--output writes all results as JSON together with version information;
+--compare prints each result against a previous JSON file.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+if not settings.configured:
+    _workdir = tempfile.mkdtemp(prefix="cryptpix-suite-")
+    settings.configure(
+        SECRET_KEY="cryptpix-benchmarks",
+        ALLOWED_HOSTS=["*"],
+        INSTALLED_APPS=[
+            "django.contrib.contenttypes",
+            "django.contrib.sessions",
+            "cryptpix",
+        ],
+        DATABASES={
+            "default": {
+                "ENGINE": "django.db.backends.sqlite3",
+                "NAME": os.path.join(_workdir, "suite.sqlite3"),
+            }
+        },
+        MIDDLEWARE=["django.contrib.sessions.middleware.SessionMiddleware"],
+        ROOT_URLCONF="cryptpix.urls",
+        MEDIA_ROOT=os.path.join(_workdir, "media"),
+        TEMPLATES=[
+            {
+                "BACKEND": "django.template.backends.django.DjangoTemplates",
+                "APP_DIRS": True,
+            }
+        ],
+        USE_TZ=True,
+        DEFAULT_AUTO_FIELD="django.db.models.BigAutoField",
+        CRYPTPIX_DELETE_WORKERS=0,
+    )
+
+import django
+
+django.setup()
+
+import PIL
+from PIL import Image, ImageFilter
+
+from cryptpix.core import (
+    build_cryptpix_layers,
+    choose_tile_size,
+    crop_to_divisible,
+    distort_image,
+    encode_layer,
+    process_and_split_image,
+    split_layers,
+)
+
+
+# (name, width, height); max sides span all three tile-size buckets
+IMAGES = [
+    ("small-landscape", 640, 427),
+    ("small-square", 768, 768),
+    ("medium-landscape", 1200, 800),
+    ("medium-portrait", 1024, 1536),
+    ("large-landscape", 3000, 2000),
+    ("large-panorama", 4200, 1800),
+    ("xlarge-landscape", 6000, 4000),
+]
+QUICK_IMAGES = ["small-landscape", "medium-portrait", "large-landscape"]
+
+STREAM_BUDGET = 16 * 1024 * 1024
+
+
+def synthetic_image(width: int, height: int) -> Image.Image:
+    """Deterministic photo-like RGB image (smooth regions plus noise)."""
+    base = Image.effect_mandelbrot((width, height), (-2.2, -1.2, 1.0, 1.2), 64)
+    noise = Image.effect_noise((width, height), 24)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    return Image.merge("RGB", (base, noise, gradient)).filter(ImageFilter.SMOOTH)
+
+
+# Measurement -----------------------------------------------------------
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class RSSSampler:
+    """Samples resident memory in a thread and records the peak growth."""
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.peak = None
+
+    def __enter__(self):
+        self.baseline = _rss_bytes()
+        self.peak = self.baseline
+        self._stop = threading.Event()
+        if self.baseline is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self.baseline is not None:
+            self._thread.join()
+            self.peak = max(self.peak, _rss_bytes())
+
+    @property
+    def growth(self):
+        if self.baseline is None:
+            return None
+        return self.peak - self.baseline
+
+
+def measure(fn, repeat: int, megapixels: float = None, operations: int = None):
+    """Best-of-repeat wall time plus memory peaks from one extra run."""
+    fn()  # warm-up (imports, caches, first allocations)
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+
+    gc.collect()
+    with RSSSampler() as sampler:
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    result = {
+        "seconds": round(seconds, 6),
+        "peak_tracemalloc_mb": round(peak / 1e6, 3),
+        "peak_rss_growth_mb": None if sampler.growth is None else round(sampler.growth / 1e6, 3),
+    }
+    if megapixels is not None:
+        result["megapixels"] = round(megapixels, 3)
+        result["mp_per_s"] = round(megapixels / seconds, 3)
+    if operations is not None:
+        result["operations"] = operations
+        result["ops_per_s"] = round(operations / seconds, 1)
+    return result
+
+
+# Core stages -----------------------------------------------------------
+
+def core_stages(image):
+    distorted, _ = distort_image(image, hue_rotation=97)
+    rgba = distorted.convert("RGBA")
+    block_size = choose_tile_size(*rgba.size)
+    cropped = crop_to_divisible(rgba, block_size)
+    layers = split_layers(cropped, block_size)
+
+    return {
+        "distort": lambda: distort_image(image, hue_rotation=97),
+        "split": lambda: split_layers(crop_to_divisible(rgba, block_size), block_size),
+        "encode_png": lambda: [encode_layer(layer) for layer in layers],
+        "process_split": lambda: process_and_split_image(distorted, include_cropped=False),
+        "build_layers": lambda: build_cryptpix_layers(
+            image, use_distortion=True, use_split=True, hue_rotation=97
+        ),
+        "build_stream": lambda: build_cryptpix_layers(
+            image, use_distortion=True, use_split=True, hue_rotation=97,
+            memory_budget=STREAM_BUDGET,
+        ),
+    }
+
+
+def run_core(images, repeat):
+    results = []
+    for name, width, height in images:
+        image = synthetic_image(width, height)
+        megapixels = width * height / 1e6
+        tile_size = choose_tile_size(width, height)
+        for stage, fn in core_stages(image).items():
+            result = measure(fn, repeat, megapixels=megapixels)
+            result.update(
+                stage=stage, image=name, width=width, height=height, tile_size=tile_size
+            )
+            results.append(result)
+            print(_format(result))
+    return results
+
+
+# Django stages ---------------------------------------------------------
+
+def run_django(repeat, photo_count=24, requests=200):
+    import io
+
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.core.cache import cache
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.core.management import call_command
+    from django.db import connection, models
+    from django.template import Context, Template
+    from django.test import Client, RequestFactory
+    from django.urls import reverse
+
+    from cryptpix.cache import local_cache
+    from cryptpix.integrations.django import CryptPixModelMixin
+    from cryptpix.utils import build_cryptpix_registry, get_image_ref, sign_image_token
+
+    class SuitePhoto(CryptPixModelMixin):
+        image = models.ImageField(upload_to="suite")
+
+        class Meta:
+            app_label = "cryptpix"
+
+    call_command("migrate", verbosity=0)
+    with connection.schema_editor() as editor:
+        editor.create_model(SuitePhoto)
+    build_cryptpix_registry()
+
+    photos = []
+    for index in range(photo_count):
+        buffer = io.BytesIO()
+        synthetic_image(640, 427).save(buffer, "JPEG")
+        photo = SuitePhoto(
+            image=SimpleUploadedFile(f"suite{index}.jpg", buffer.getvalue()),
+            use_split=index % 4 != 0,
+        )
+        photo.save()
+        photos.append(photo)
+
+    client = Client()
+    session_request = RequestFactory().get("/")
+    session_request.session = SessionStore()
+    session_request.session.create()
+    client.cookies["sessionid"] = session_request.session.session_key
+
+    urls = [
+        reverse(
+            "secure-image",
+            args=[sign_image_token(f"{get_image_ref(photo)}_1", session_request.session.session_key)],
+        )
+        for photo in photos
+    ]
+
+    def fetch_all(clear_cache):
+        for index in range(requests):
+            if clear_cache:
+                local_cache.clear()
+                cache.clear()
+            response = client.get(urls[index % len(urls)])
+            b"".join(response.streaming_content)
+            assert response.status_code == 200, response.status_code
+
+    image_tag = Template(
+        '{% load cryptpix_tags %}{% for p in photos %}{% cryptpix_image p class="thumb" %}{% endfor %}'
+    )
+    gallery_tag = Template('{% load cryptpix_tags %}{% cryptpix_gallery photos class="thumb" %}')
+    context = Context({"photos": photos, "request": session_request})
+
+    stages = {
+        "view_cached": (lambda: fetch_all(False), requests),
+        "view_uncached": (lambda: fetch_all(True), requests),
+        "tag_image": (lambda: image_tag.render(context), photo_count),
+        "tag_gallery": (lambda: gallery_tag.render(context), photo_count),
+    }
+    results = []
+    for stage, (fn, operations) in stages.items():
+        result = measure(fn, repeat, operations=operations)
+        result.update(stage=stage, image=f"{photo_count} photos 640x427")
+        results.append(result)
+        print(_format(result))
+    return results
+
+
+# Output ----------------------------------------------------------------
+
+def _format(result):
+    rate = (
+        f"{result['mp_per_s']:>9.1f} MP/s"
+        if "mp_per_s" in result
+        else f"{result['ops_per_s']:>9.0f} op/s"
+    )
+    rss = result["peak_rss_growth_mb"]
+    rss = "-" if rss is None else f"{rss:.1f}"
+    return (
+        f"{result['stage']:<14} {result['image']:<20} {result['seconds'] * 1000:>10.1f} ms "
+        f"{rate} {result['peak_tracemalloc_mb']:>9.1f} MB py {rss:>8} MB rss"
+    )
+
+
+def _result_key(result):
+    return f"{result['stage']}:{result['image']}"
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "django": django.get_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as fp:
+        baseline = {_result_key(result): result for result in json.load(fp)["results"]}
+
+    print(f"\nvs {baseline_path} (time ratio < 1.00 is faster)")
+    print(f"{'stage':<14} {'image':<20} {'time':>8} {'py peak':>8}")
+    for result in results:
+        before = baseline.get(_result_key(result))
+        if before is None:
+            continue
+        time_ratio = result["seconds"] / before["seconds"]
+        peak_ratio = (
+            result["peak_tracemalloc_mb"] / before["peak_tracemalloc_mb"]
+            if before["peak_tracemalloc_mb"]
+            else float("nan")
+        )
+        print(f"{result['stage']:<14} {result['image']:<20} {time_ratio:>7.2f}x {peak_ratio:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quick", action="store_true", help="three images only")
+    parser.add_argument("--only", choices=("core", "django"))
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON file from a previous run")
+    args = parser.parse_args()
+
+    images = [image for image in IMAGES if not args.quick or image[0] in QUICK_IMAGES]
+
+    results = []
+    if args.only in (None, "core"):
+        results += run_core(images, args.repeat)
+    if args.only in (None, "django"):
+        results += run_django(args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({"environment": environment(), "results": results}, fp, indent=2)
+        print(f"\nwrote {len(results)} results to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
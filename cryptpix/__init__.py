@@ -1,9 +1,10 @@
-from .core import process_and_split_image, distort_image
+from .core import process_and_split_image, distort_image, LayerEncoding
 from .html import get_css, render_image_stack
 
 __all__ = [
     'process_and_split_image',
     'distort_image',
+    'LayerEncoding',
     'get_css',
     'render_image_stack',
 ]
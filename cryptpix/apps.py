@@ -1,8 +1,17 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.utils.module_loading import import_string
 
 class CryptPixConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cryptpix'
 
     def ready(self):
-        import cryptpix.signals
\ No newline at end of file
+        from .instrumentation import add_stage_hook
+        from .signals import connect_signals
+        from .utils import build_cryptpix_registry
+
+        connect_signals(build_cryptpix_registry().values())
+
+        for path in getattr(settings, "CRYPTPIX_INSTRUMENTATION_HOOKS", ()):
+            add_stage_hook(import_string(path)())
@@ -0,0 +1,161 @@
+"""Process-pool batch generation of CryptPix derivatives."""
+
+from __future__ import annotations
+
+import os
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional, Tuple, Union
+
+from PIL import Image
+
+from .core import LayerEncoding, build_cryptpix_layers
+
+
+BatchSource = Union[str, Path, bytes, Image.Image]
+
+
+@dataclass
+class BatchResult:
+    """Outcome of one batch item.
+
+    ``layers`` is the ``build_cryptpix_layers`` tuple on success; ``error``
+    holds the exception raised for this item otherwise.
+    """
+
+    index: int
+    source: Any
+    layers: Optional[Tuple] = None
+    error: Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+_SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def _share_image(image: Image.Image):
+    if image.mode in ("P", "PA"):
+        # Palette data is not part of tobytes(); expand it first.
+        image = image.convert("RGBA")
+    with tempfile.NamedTemporaryFile(prefix="cryptpix-", dir=_SHARED_DIR, delete=False) as fp:
+        fp.write(image.tobytes())
+    return fp.name, ("raw", fp.name, image.mode, image.size)
+
+
+def _release_shared(name: Optional[str]) -> None:
+    if name is not None:
+        try:
+            os.unlink(name)
+        except FileNotFoundError:
+            pass
+
+
+def _load_payload(payload):
+    kind = payload[0]
+    if kind == "path":
+        return payload[1]
+    if kind == "bytes":
+        return Image.open(BytesIO(payload[1]))
+
+    _, name, mode, size = payload
+    with open(name, "rb") as fp:
+        return Image.frombytes(mode, size, fp.read())
+
+
+def _build_layers_worker(payload, options):
+    return build_cryptpix_layers(_load_payload(payload), **options)
+
+
+def build_cryptpix_layers_batch(
+    sources: Iterable[BatchSource],
+    *,
+    use_distortion: bool,
+    use_split: bool,
+    memory_budget: Optional[int] = None,
+    encoding: Optional[LayerEncoding] = None,
+    max_dimension: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    max_pending: Optional[int] = None,
+    executor: Optional[Executor] = None,
+) -> Iterator[BatchResult]:
+    """Generate derivatives for many images on a process pool.
+
+    Results are yielded in completion order; use ``BatchResult.index`` to
+    map them back to the input position. A failing item yields a result
+    with ``error`` set and does not stop the batch.
+
+    ``sources`` is consumed lazily: at most ``max_pending`` items (default
+    twice the worker count) are in flight, so arbitrarily long iterables can
+    be streamed without queueing every job up front.
+
+    Pass ``executor`` to reuse an existing pool; it is not shut down here.
+    Sources are never pickled as images: paths and encoded bytes are sent
+    as-is, PIL images through a shared-memory file.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or max_workers * 2
+    options = dict(
+        use_distortion=use_distortion,
+        use_split=use_split,
+        memory_budget=memory_budget,
+        encoding=encoding,
+        max_dimension=max_dimension,
+    )
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    pending = {}
+    source_iter = enumerate(sources)
+    exhausted = False
+
+    try:
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    index, source = next(source_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                shared = None
+                try:
+                    if isinstance(source, Image.Image):
+                        shared, payload = _share_image(source)
+                    elif isinstance(source, (bytes, bytearray, memoryview)):
+                        payload = ("bytes", bytes(source))
+                    else:
+                        payload = ("path", str(source))
+                    future = executor.submit(_build_layers_worker, payload, options)
+                except Exception as exc:
+                    _release_shared(shared)
+                    yield BatchResult(index=index, source=source, error=exc)
+                    continue
+                pending[future] = (index, source, shared)
+
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, source, shared = pending.pop(future)
+                _release_shared(shared)
+                error = future.exception()
+                if error is not None:
+                    yield BatchResult(index=index, source=source, error=error)
+                else:
+                    yield BatchResult(index=index, source=source, layers=future.result())
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
+        for _, _, shared in pending.values():
+            _release_shared(shared)
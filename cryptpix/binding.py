@@ -0,0 +1,74 @@
+"""What a signed image token is bound to: the session key or a signed client cookie."""
+
+import secrets
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+_COOKIE_SALT = "cryptpix.binding.client"
+
+
+def _binding() -> str:
+    binding = getattr(settings, "CRYPTPIX_TOKEN_BINDING", "session")
+    if binding not in ("session", "cookie"):
+        raise ImproperlyConfigured(f"Unknown CRYPTPIX_TOKEN_BINDING: {binding!r}")
+    return binding
+
+
+def _cookie_name() -> str:
+    return getattr(settings, "CRYPTPIX_CLIENT_COOKIE", "cryptpix_client")
+
+
+def _client_cookie_key(request):
+    key = getattr(request, "_cryptpix_client_key", None)
+    if key is None:
+        key = request.get_signed_cookie(_cookie_name(), default=None, salt=_COOKIE_SALT)
+    return key
+
+
+def get_binding_key(request, create: bool = True):
+    """The key tokens for this client are bound to.
+
+    With ``create`` a missing key is made (a new session, or a cookie key
+    that ClientCookieMiddleware sends back); otherwise None is returned.
+    """
+    if _binding() == "session":
+        if create and not request.session.session_key:
+            request.session.create()
+        return request.session.session_key
+
+    key = _client_cookie_key(request)
+    if key is None and create:
+        if not getattr(request, "_cryptpix_client_cookie_middleware", False):
+            # The key would never reach the client and every token would fail
+            raise ImproperlyConfigured(
+                'CRYPTPIX_TOKEN_BINDING = "cookie" requires '
+                '"cryptpix.binding.ClientCookieMiddleware" in MIDDLEWARE.'
+            )
+        key = secrets.token_urlsafe(16)
+        request._cryptpix_client_key = key
+        request._cryptpix_set_client_cookie = True
+    return key
+
+
+class ClientCookieMiddleware:
+    """Sets the signed client cookie for CRYPTPIX_TOKEN_BINDING = "cookie"."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request._cryptpix_client_cookie_middleware = True
+        response = self.get_response(request)
+        if getattr(request, "_cryptpix_set_client_cookie", False):
+            response.set_signed_cookie(
+                _cookie_name(),
+                request._cryptpix_client_key,
+                salt=_COOKIE_SALT,
+                max_age=getattr(settings, "CRYPTPIX_CLIENT_COOKIE_AGE", 30 * 24 * 3600),
+                secure=request.is_secure(),
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
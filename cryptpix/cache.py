@@ -0,0 +1,153 @@
+"""Cache of (model, pk, layer) → (storage name, content type, mtime) for serving."""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .utils import get_model_key
+
+
+LAYERS = (0, 1, 2)
+
+
+class LocalLRU:
+    """Thread-safe LRU with per-entry expiry."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+local_cache = LocalLRU(
+    maxsize=getattr(settings, "CRYPTPIX_LAYER_CACHE_LOCAL_SIZE", 1024),
+    ttl=getattr(settings, "CRYPTPIX_LAYER_CACHE_LOCAL_TTL", 60),
+)
+
+
+def _shared_cache():
+    alias = getattr(settings, "CRYPTPIX_LAYER_CACHE", "default")
+    return caches[alias] if alias else None
+
+
+def _cache_key(model_key, pk, layer) -> str:
+    return f"cryptpix:layer:{model_key}:{pk}:{layer}"
+
+
+def get_layer_entry(model_key, pk, layer):
+    """Cached (storage_name, content_type, last_modified) for a layer, or None."""
+    key = _cache_key(model_key, pk, layer)
+    entry = local_cache.get(key)
+    if entry is not None:
+        return entry
+
+    shared = _shared_cache()
+    if shared is None:
+        return None
+    entry = shared.get(key)
+    if entry is None or len(entry) != 3:
+        return None
+    entry = tuple(entry)
+    local_cache.set(key, entry)
+    return entry
+
+
+def set_layer_entry(model_key, pk, layer, name, content_type, last_modified=None) -> None:
+    """Cache a layer's storage name, content type and modification timestamp."""
+    key = _cache_key(model_key, pk, layer)
+    entry = (name, content_type, last_modified)
+    local_cache.set(key, entry)
+
+    shared = _shared_cache()
+    if shared is not None:
+        shared.set(key, entry, getattr(settings, "CRYPTPIX_LAYER_CACHE_TIMEOUT", 86400))
+
+
+async def aget_layer_entry(model_key, pk, layer):
+    """Async ``get_layer_entry``."""
+    key = _cache_key(model_key, pk, layer)
+    entry = local_cache.get(key)
+    if entry is not None:
+        return entry
+
+    shared = _shared_cache()
+    if shared is None:
+        return None
+    entry = await shared.aget(key)
+    if entry is None or len(entry) != 3:
+        return None
+    entry = tuple(entry)
+    local_cache.set(key, entry)
+    return entry
+
+
+async def aset_layer_entry(model_key, pk, layer, name, content_type, last_modified=None) -> None:
+    """Async ``set_layer_entry``."""
+    key = _cache_key(model_key, pk, layer)
+    entry = (name, content_type, last_modified)
+    local_cache.set(key, entry)
+
+    shared = _shared_cache()
+    if shared is not None:
+        await shared.aset(key, entry, getattr(settings, "CRYPTPIX_LAYER_CACHE_TIMEOUT", 86400))
+
+
+def variant_widths(manifest) -> list:
+    """The variant widths in a derivative_manifest, which its cache entries are keyed by."""
+    return [entry["width"] for entry in manifest or () if entry.get("width")]
+
+
+def invalidate_layer_cache(model, pk, widths=()) -> None:
+    """Drop every cached layer of one instance (on delete and regeneration).
+
+    ``widths`` are the variant widths to drop as well. Pass the widths of
+    the manifest the layers were served from (see variant_widths); they are
+    cropped to tile multiples, so they are not the model's cryptpix_widths.
+    """
+    model_key = get_model_key(model)
+    keys = [_cache_key(model_key, pk, layer) for layer in LAYERS]
+    # Variant entries are keyed "{layer}@{width}"
+    keys += [
+        _cache_key(model_key, pk, f"{layer}@{width}")
+        for width in dict.fromkeys(widths)
+        for layer in (1, 2)
+    ]
+    for key in keys:
+        local_cache.delete(key)
+
+    shared = _shared_cache()
+    if shared is not None:
+        shared.delete_many(keys)
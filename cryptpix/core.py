@@ -13,17 +13,49 @@ The Django model mixin can use these helpers to generate either:
 
 from __future__ import annotations
 
+import hashlib
 import random
+from dataclasses import dataclass
 from io import BytesIO
 from pathlib import Path
-from typing import Optional, Tuple, Union
+from typing import BinaryIO, List, Optional, Tuple, Union
 
 from PIL import Image, ImageOps
 
+from .instrumentation import stage
+
 
 PILImageOrPath = Union[Image.Image, str, Path]
 
 
+@dataclass(frozen=True)
+class LayerEncoding:
+    """How derivative layers are encoded.
+
+    Attributes:
+        format: "PNG" or "WEBP" (always lossless).
+        compress_level: PNG zlib level 0–9; lower is faster, higher is smaller.
+        optimize: PNG extra compression pass (slow; overrides compress_level).
+        webp_method: WebP effort 0–6; higher is slower and smaller.
+        quantize_colors: If set, palette-quantize layers to this many colors
+            before encoding. Lossy, but split layers are half transparent
+            and compress very well as palette images.
+    """
+
+    format: str = "PNG"
+    compress_level: int = 6
+    optimize: bool = False
+    webp_method: int = 4
+    quantize_colors: Optional[int] = None
+
+    @property
+    def extension(self) -> str:
+        return "webp" if self.format.upper() == "WEBP" else "png"
+
+
+DEFAULT_LAYER_ENCODING = LayerEncoding()
+
+
 def choose_tile_size(width: int, height: int) -> int:
     """Pick a tile size based on max dimension."""
     max_dim = max(width, height)
@@ -34,22 +66,122 @@ def choose_tile_size(width: int, height: int) -> int:
     return 12
 
 
-def _open_image(image_or_path: PILImageOrPath) -> Image.Image:
+_EXIF_ORIENTATION = 0x0112
+# Orientations that swap width and height (rotated by 90 or 270 degrees)
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def _scaled_size(width: int, height: int, max_dimension: int) -> Tuple[int, int]:
+    scale = max_dimension / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _open_lazily(image_or_path: Union[PILImageOrPath, BinaryIO]) -> Image.Image:
     if isinstance(image_or_path, Image.Image):
         return image_or_path
+    if hasattr(image_or_path, "read"):
+        # Binary file object (e.g. a storage file); load() before closing it
+        return Image.open(image_or_path)
     return Image.open(str(image_or_path))
 
 
-def distort_image(image_or_path: PILImageOrPath) -> Tuple[Image.Image, int]:
-    """Apply a random hue rotation (30–180 degrees) and invert colors.
+def _upright_target(img: Image.Image, max_dimension: Optional[int]):
+    """(orientation, upright output size or None) from the header alone."""
+    orientation = img.getexif().get(_EXIF_ORIENTATION, 1)
+    if not max_dimension or max(img.size) <= max_dimension:
+        return orientation, None
+    width, height = _scaled_size(*img.size, max_dimension)
+    if orientation in _TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    return orientation, (width, height)
+
+
+def open_source_image(
+    image_or_path: Union[PILImageOrPath, BinaryIO], max_dimension: Optional[int] = None
+) -> Image.Image:
+    """Open a source image upright and, optionally, no larger than ``max_dimension``.
+
+    EXIF orientation is applied here, once, so every later stage works on
+    upright pixels. With ``max_dimension`` the image is shrunk while it is
+    decoded where the format allows it (JPEG ``draft`` decodes at 1/2, 1/4
+    or 1/8 scale directly from the DCT data), and the rest of the way with
+    ``resize``'s ``reducing_gap`` (a cheap integer ``reduce`` followed by a
+    short LANCZOS pass), before any per-pixel work happens.
+
+    Images already at or below ``max_dimension`` are returned unchanged
+    (apart from orientation). Passing an image that has been loaded skips
+    the decoder shortcut but still downscales.
+    """
+    img = _open_lazily(image_or_path)
+    orientation, target = _upright_target(img, max_dimension)
+    if target is not None:
+        # No-op for formats without decoder scaling and for loaded images
+        img.draft(None, target if orientation not in _TRANSPOSED_ORIENTATIONS else target[::-1])
 
-    Accepts either a PIL Image or a filesystem path.
+    if orientation != 1:
+        img = ImageOps.exif_transpose(img)
 
-    Returns:
-        (distorted_image_rgb, hue_rotation_degrees)
+    if target is not None and img.size != target:
+        img = img.resize(target, Image.LANCZOS, reducing_gap=3.0)
+    return img
+
+
+def layer_geometry(
+    image_or_path: Union[PILImageOrPath, BinaryIO],
+    *,
+    use_split: bool,
+    max_dimension: Optional[int] = None,
+) -> Tuple[Optional[int], int, int]:
+    """(tile_size, width, height) that build_cryptpix_layers will produce.
+
+    Only the image header is read, so this is cheap enough to call before
+    (or instead of) generating the layers. tile_size is None when not split.
+    """
+    img = _open_lazily(image_or_path)
+    orientation, target = _upright_target(img, max_dimension)
+    width, height = target or img.size
+    if target is None and orientation in _TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    if not use_split:
+        return None, width, height
+    tile_size = choose_tile_size(width, height)
+    return tile_size, width - width % tile_size, height - height % tile_size
+
+
+def _open_image(image_or_path: PILImageOrPath) -> Image.Image:
+    return open_source_image(image_or_path)
+
+
+def _hue_shift_lut(hue_rotation: int) -> list:
+    """Build a 3-band HSV lookup table that shifts hue and keeps S/V as-is."""
+    # Pillow hue is 0–255, so scale the rotation accordingly
+    hue_shift = int((hue_rotation / 360.0) * 255)
+    identity = list(range(256))
+    return [(value + hue_shift) % 256 for value in identity] + identity + identity
+
+
+_INVERT_LUT = list(range(255, -1, -1)) * 3
+
+
+def rotate_hue_and_invert(image: Image.Image, hue_rotation: int) -> Image.Image:
+    """Rotate hue by ``hue_rotation`` degrees and invert an image's colors.
+
+    The whole chain runs as bulk Pillow operations: one RGB→HSV conversion,
+    a single ``point`` table for the hue shift, one HSV→RGB conversion and a
+    second ``point`` table for the inversion. No band split/merge and no
+    per-pixel Python work.
+
+    Output is byte-identical to ``_rotate_hue_and_invert_reference``.
     """
-    hue_rotation = random.randint(30, 180)
-    img = _open_image(image_or_path).convert("RGB")
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    hsv = image.convert("HSV").point(_hue_shift_lut(hue_rotation))
+    return hsv.convert("RGB").point(_INVERT_LUT)
+
+
+def _rotate_hue_and_invert_reference(image: Image.Image, hue_rotation: int) -> Image.Image:
+    """Original per-pixel implementation, kept as a reference for equivalence checks."""
+    img = image.convert("RGB")
 
     # Convert to HSV
     hsv = img.convert("HSV")
@@ -66,7 +198,24 @@ def distort_image(image_or_path: PILImageOrPath) -> Tuple[Image.Image, int]:
     distorted_rgb = Image.merge("HSV", (h, s, v)).convert("RGB")
 
     # Invert colors
-    final_image = ImageOps.invert(distorted_rgb)
+    return ImageOps.invert(distorted_rgb)
+
+
+def distort_image(
+    image_or_path: PILImageOrPath,
+    hue_rotation: Optional[int] = None,
+) -> Tuple[Image.Image, int]:
+    """Apply a random hue rotation (30–180 degrees) and invert colors.
+
+    Accepts either a PIL Image or a filesystem path. Pass ``hue_rotation`` to
+    use a fixed rotation instead of a random one.
+
+    Returns:
+        (distorted_image_rgb, hue_rotation_degrees)
+    """
+    if hue_rotation is None:
+        hue_rotation = random.randint(30, 180)
+    final_image = rotate_hue_and_invert(_open_image(image_or_path), hue_rotation)
     return final_image, hue_rotation
 
 
@@ -79,32 +228,75 @@ def crop_to_divisible(image: Image.Image, block_size: int) -> Image.Image:
 
 
 def _image_to_png_bytes(image: Image.Image) -> BytesIO:
+    return encode_layer(image, DEFAULT_LAYER_ENCODING)
+
+
+def encode_layer(image: Image.Image, encoding: Optional[LayerEncoding] = None) -> BytesIO:
+    """Encode an image according to a LayerEncoding (defaults to plain PNG)."""
+    encoding = encoding or DEFAULT_LAYER_ENCODING
+    fmt = encoding.format.upper()
+
+    if encoding.quantize_colors:
+        image = image.quantize(colors=encoding.quantize_colors, method=Image.Quantize.FASTOCTREE)
+
     buf = BytesIO()
-    image.save(buf, format="PNG")
+    if fmt == "PNG":
+        image.save(buf, format="PNG", compress_level=encoding.compress_level, optimize=encoding.optimize)
+    elif fmt == "WEBP":
+        # exact=True keeps RGB under fully transparent pixels untouched
+        image.save(buf, format="WEBP", lossless=True, exact=True, method=encoding.webp_method)
+    else:
+        raise ValueError(f"Unsupported layer format: {encoding.format!r}")
     buf.seek(0)
     return buf
 
 
-def process_and_split_image(image: Image.Image):
-    """Split an image into two checkerboard layers.
+def _checkerboard_mask(width: int, height: int, block_size: int, *, first_layer: bool) -> Image.Image:
+    """Build an "L" mask that is 255 on the tiles belonging to one layer.
 
-    Args:
-        image: PIL.Image to split
+    Tile (0, 0) belongs to the first layer. The mask is assembled from
+    repeated byte strings, so building it costs a handful of bulk copies.
+    """
+    on, off = b"\xff" * block_size, b"\x00" * block_size
+    if not first_layer:
+        on, off = off, on
 
-    Returns:
-        (cropped_buffer, layer1_buffer, layer2_buffer, block_size, width, height)
+    tiles_x = width // block_size
+    row_even = (on + off) * (tiles_x // 2) + (on if tiles_x % 2 else b"")
+    row_odd = (off + on) * (tiles_x // 2) + (off if tiles_x % 2 else b"")
+
+    tiles_y = height // block_size
+    band_even, band_odd = row_even * block_size, row_odd * block_size
+    data = (band_even + band_odd) * (tiles_y // 2) + (band_even if tiles_y % 2 else b"")
+    return Image.frombytes("L", (width, height), data)
+
+
+def split_layers(image: Image.Image, block_size: int) -> Tuple[Image.Image, Image.Image]:
+    """Split an RGBA image into two checkerboard layers.
+
+    ``image`` must already be cropped to a multiple of ``block_size``. Each
+    layer is a single masked ``paste`` onto a transparent canvas; pixels on
+    the other layer's tiles stay (0, 0, 0, 0).
+
+    Output is pixel-identical to ``_split_layers_reference``.
     """
-    image = image.convert("RGBA")
     width, height = image.size
+    layers = []
+    for first_layer in (True, False):
+        layer = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        layer.paste(image, (0, 0), _checkerboard_mask(width, height, block_size, first_layer=first_layer))
+        layers.append(layer)
+    return layers[0], layers[1]
 
-    block_size = choose_tile_size(width, height)
-    cropped_image = crop_to_divisible(image, block_size)
-    width, height = cropped_image.size
+
+def _split_layers_reference(image: Image.Image, block_size: int) -> Tuple[Image.Image, Image.Image]:
+    """Original per-pixel implementation, kept as a reference for equivalence checks."""
+    width, height = image.size
 
     layer1 = Image.new("RGBA", (width, height), (0, 0, 0, 0))
     layer2 = Image.new("RGBA", (width, height), (0, 0, 0, 0))
 
-    original_pixels = cropped_image.load()
+    original_pixels = image.load()
     pixels1 = layer1.load()
     pixels2 = layer2.load()
 
@@ -120,9 +312,45 @@ def process_and_split_image(image: Image.Image):
                     else:
                         pixels2[px, py] = pixel
 
-    cropped_buffer = _image_to_png_bytes(cropped_image)
-    buffer1 = _image_to_png_bytes(layer1)
-    buffer2 = _image_to_png_bytes(layer2)
+    return layer1, layer2
+
+
+def _encode_layer_stage(image: Image.Image, encoding: Optional[LayerEncoding], layer: int) -> BytesIO:
+    with stage("encode", layer=layer) as timing:
+        buffer = encode_layer(image, encoding)
+        timing.record(buffer.getbuffer().nbytes)
+    return buffer
+
+
+def process_and_split_image(
+    image: Image.Image,
+    *,
+    include_cropped: bool = True,
+    encoding: Optional[LayerEncoding] = None,
+):
+    """Split an image into two checkerboard layers.
+
+    Args:
+        image: PIL.Image to split
+        include_cropped: Also encode the cropped (unsplit) image. Pass False
+            when the caller discards it; cropped_buffer is then None.
+        encoding: LayerEncoding for the layers (the cropped image is always PNG).
+
+    Returns:
+        (cropped_buffer, layer1_buffer, layer2_buffer, block_size, width, height)
+    """
+    image = image.convert("RGBA")
+    width, height = image.size
+
+    block_size = choose_tile_size(width, height)
+    with stage("split", tile_size=block_size):
+        cropped_image = crop_to_divisible(image, block_size)
+        layer1, layer2 = split_layers(cropped_image, block_size)
+    width, height = cropped_image.size
+
+    cropped_buffer = _image_to_png_bytes(cropped_image) if include_cropped else None
+    buffer1 = _encode_layer_stage(layer1, encoding, 1)
+    buffer2 = _encode_layer_stage(layer2, encoding, 2)
     return cropped_buffer, buffer1, buffer2, block_size, width, height
 
 
@@ -131,6 +359,10 @@ def build_cryptpix_layers(
     *,
     use_distortion: bool,
     use_split: bool,
+    memory_budget: Optional[int] = None,
+    encoding: Optional[LayerEncoding] = None,
+    hue_rotation: Optional[int] = None,
+    max_dimension: Optional[int] = None,
 ) -> Tuple[BytesIO, Optional[BytesIO], Optional[int], int, int, Optional[int]]:
     """Generate the derivative(s) CryptPix stores.
 
@@ -141,21 +373,121 @@ def build_cryptpix_layers(
       - If use_split is False: returns (layer1, None, None, w, h, hue_rotation)
 
     Notes:
-      - Returned images are PNG BytesIO objects.
+      - Returned images are BytesIO objects encoded per ``encoding``
+        (PNG by default).
       - hue_rotation is only returned when use_distortion is True.
+      - Pass memory_budget (bytes) to process the image in tile-aligned
+        strips with incremental PNG encoding; see cryptpix.streaming.
+      - Pass hue_rotation to reuse a rotation (e.g. for smaller variants of
+        the same image); a random one is picked otherwise.
+      - Pass max_dimension to cap the longer side of the output; the source
+        is downscaled while decoding (see open_source_image).
     """
-    img = _open_image(source)
-    hue_rotation: Optional[int] = None
+    if memory_budget is not None:
+        from .streaming import stream_cryptpix_layers
+
+        if max_dimension:
+            with stage("decode"):
+                source = open_source_image(source, max_dimension)
+        with stage("stream") as timing:
+            layers = stream_cryptpix_layers(
+                source,
+                use_distortion=use_distortion,
+                use_split=use_split,
+                memory_budget=memory_budget,
+                hue_rotation=hue_rotation,
+                encoding=encoding,
+            )
+            timing.record(sum(buffer.getbuffer().nbytes for buffer in layers[:2] if buffer is not None))
+        return layers
+
+    with stage("decode") as timing:
+        img = open_source_image(source, max_dimension)
+        img.load()
+        timing.record(width=img.width, height=img.height)
 
     if use_distortion:
-        img, hue_rotation = distort_image(img)
+        with stage("distort"):
+            img, hue_rotation = distort_image(img, hue_rotation)
+    else:
+        hue_rotation = None
 
     if use_split:
-        _, layer1_io, layer2_io, tile_size, width, height = process_and_split_image(img)
+        _, layer1_io, layer2_io, tile_size, width, height = process_and_split_image(
+            img, include_cropped=False, encoding=encoding
+        )
         return layer1_io, layer2_io, tile_size, width, height, hue_rotation
 
-    # Not split: store a single PNG derivative in layer 1
+    # Not split: store a single derivative in layer 1
     img_rgba = img.convert("RGBA")
     width, height = img_rgba.size
-    layer1_io = _image_to_png_bytes(img_rgba)
+    layer1_io = _encode_layer_stage(img_rgba, encoding, 1)
     return layer1_io, None, None, width, height, hue_rotation
+
+
+def build_cryptpix_pyramid(
+    source: PILImageOrPath,
+    widths,
+    *,
+    use_distortion: bool,
+    use_split: bool,
+    hue_rotation: Optional[int] = None,
+    encoding: Optional[LayerEncoding] = None,
+    max_dimension: Optional[int] = None,
+    memory_budget: Optional[int] = None,
+) -> List[Tuple[int, Tuple]]:
+    """Generate downscaled variants of an image for responsive serving.
+
+    For every width in ``widths`` that is smaller than the source, the
+    source is resized (aspect ratio kept) and run through
+    ``build_cryptpix_layers``, so each variant is split with a tile size
+    chosen for its own dimensions. Pass the full-size ``hue_rotation`` so all
+    variants share it (one CSS filter reverses every resolution), and the
+    same ``max_dimension`` so no variant is wider than the full-size layers.
+    ``memory_budget`` is passed on, so variants are streamed in strips too.
+
+    Returns ``[(width, layers), ...]`` in ascending width order, where
+    ``layers`` follows the ``build_cryptpix_layers`` tuple contract.
+    """
+    img = open_source_image(source, max_dimension)
+    if img.mode not in ("RGB", "RGBA", "L", "LA"):
+        img = img.convert("RGBA")
+    full_width, full_height = img.size
+
+    variants = []
+    for width in sorted(set(widths)):
+        if width >= full_width:
+            continue
+        height = max(1, round(full_height * width / full_width))
+        with stage("resize", width=width):
+            resized = img.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+        layers = build_cryptpix_layers(
+            resized,
+            use_distortion=use_distortion,
+            use_split=use_split,
+            memory_budget=memory_budget,
+            encoding=encoding,
+            hue_rotation=hue_rotation,
+        )
+        variants.append((width, layers))
+    return variants
+
+
+def content_digest(image: Image.Image, **params) -> str:
+    """Hex digest of an image's decoded pixels plus the given generation parameters.
+
+    Two uploads that decode to the same pixels and are processed with the
+    same parameters get the same digest, whatever their file format or
+    metadata. Pixels are hashed in row bands to avoid a full-size copy.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(repr(sorted(params.items())).encode())
+    digest.update(f"{image.mode}:{image.size}".encode())
+    if image.mode == "P":
+        digest.update(bytes(image.getpalette() or ()))
+
+    width, height = image.size
+    band = max(1, (4 * 1024 * 1024) // max(1, width * 4))
+    for top in range(0, height, band):
+        digest.update(image.crop((0, top, width, min(height, top + band))).tobytes())
+    return digest.hexdigest()
@@ -1,10 +1,21 @@
+from django.conf import settings
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.urls import reverse
 
-from .utils import sign_image_token
+from .binding import get_binding_key
+from .cache import LocalLRU
+from .utils import (
+    get_cryptpix_model,
+    get_image_ref,
+    get_model_key,
+    sign_image_token,
+    sign_image_tokens,
+)
 
 import json
+import re
+import secrets
 
 
 def get_css():
@@ -58,29 +69,59 @@ def get_css():
 """
 
 
+def _secure_image_url_name():
+    return getattr(settings, "CRYPTPIX_SECURE_IMAGE_URL_NAME", "secure-image")
+
+
+def layers_renderable(photo) -> bool:
+    """Whether a photo's layer URLs can be rendered (else a pending placeholder)."""
+    if getattr(photo, "processing_state", "ready") == "ready":
+        return True
+    # Lazy rows know their geometry; the first layer request generates the files
+    return (
+        getattr(photo, "cryptpix_generation_mode", None) == "lazy"
+        and getattr(photo, "image_width", None) is not None
+    )
+
+
 def get_secure_image_url(image_id, request):
-    # Ensure session key exists
-    if not request.session.session_key:
-        request.session.create()
+    # Session key or client cookie key, created if missing (see cryptpix.binding)
+    binding_key = get_binding_key(request)
 
-    token = sign_image_token(image_id, request.session.session_key)
-    url = reverse("secure-image", args=[token])
+    token = sign_image_token(image_id, binding_key)
+    url = reverse(_secure_image_url_name(), args=[token])
     return url
 
 
+_TOKEN_PLACEHOLDER = "cryptpix-token"
+
+
+def _secure_image_url_affixes():
+    """
+    (prefix, suffix) around the token in a secure image URL, from one reverse().
+
+    Signed tokens only contain URL-safe base64 characters, ':' and '@', which
+    reverse() never escapes, so prefix + token + suffix is the same URL.
+    """
+    url = reverse(_secure_image_url_name(), args=[_TOKEN_PLACEHOLDER])
+    prefix, _, suffix = url.partition(_TOKEN_PLACEHOLDER)
+    return prefix, suffix
+
+
+_CLASS_ATTR_RE = re.compile(r'class=["\'](.*?)["\']')
+
+
 def add_lazy_class(attrs: str) -> str:
     """
     Ensure that the 'lazy' class is added to the class attribute in attrs.
     If no class attribute exists, add one.
     """
-    import re
-
-    class_match = re.search(r'class=["\'](.*?)["\']', attrs)
+    class_match = _CLASS_ATTR_RE.search(attrs)
     if class_match:
         classes = class_match.group(1).split()
         if "lazy" not in classes:
             classes.append("lazy")
-        attrs = re.sub(r'class=["\'](.*?)["\']', f'class="{" ".join(classes)}"', attrs)
+        attrs = _CLASS_ATTR_RE.sub(f'class="{" ".join(classes)}"', attrs)
     else:
         attrs = f'class="lazy" {attrs}'.strip()
 
@@ -109,10 +150,16 @@ def render_single_image(
     img_attrs="",
     natural_width=None,
     natural_height=None,
+    variants=None,
+    sizes=None,
 ):
     """
     Render a single secure image.
 
+    ``variants`` is the instance's derivative_manifest; when given, the
+    <img> also gets data-srcset/data-sizes (applied by the lazy loader) so
+    the browser picks the resolution it needs.
+
     Backwards-compatible DOM contract:
       - Emit the SAME wrapper element/class as render_image_stack (.image-stack)
       - Keep the SAME <img> class and data-* attributes contract as stacked <img>s
@@ -120,9 +167,57 @@ def render_single_image(
 
     Stack-only behavior is gated elsewhere by data-layout="stack" vs "single".
     """
-    img_attrs = add_lazy_class(img_attrs)
+    src = escape(get_secure_image_url(f"{image_id}_{layer}", request))
+    srcset_attrs = _srcset_attrs(
+        src, natural_width, _variant_srcs(image_id, layer, variants, request), sizes
+    )
+    return _single_image_html(
+        src,
+        add_lazy_class(img_attrs),
+        use_distortion,
+        hue_rotation,
+        natural_width,
+        natural_height,
+        srcset_attrs,
+    )
+
+
+def _variant_srcs(image_id, layer, variants, request):
+    """[(escaped URL, width), ...] for one layer of the stored variants."""
+    return [
+        (escape(get_secure_image_url(f"{image_id}_{layer}@{variant['width']}", request)), variant["width"])
+        for variant in variants or ()
+        if variant.get(f"layer_{layer}")
+    ]
+
+
+def _srcset_attrs(src, width, variant_srcs, sizes):
+    """data-srcset/data-sizes for the variants plus the full-size image; "" without variants."""
+    if not variant_srcs:
+        return ""
+    candidates = list(variant_srcs)
+    if width is not None:
+        candidates.append((src, width))
+    srcset = ", ".join(f"{url} {candidate_width}w" for url, candidate_width in candidates)
+    return f' data-srcset="{srcset}" data-sizes="{escape(sizes or "100vw")}"'
+
+
+def _variants_attr(variants):
+    """data-variants for a stack's .tile-meta: each split variant's geometry; "" without any."""
+    geometry = [
+        {"width": variant["width"], "height": variant["height"], "tile_size": variant["tile_size"]}
+        for variant in variants or ()
+        if variant.get("layer_1") and variant.get("layer_2")
+    ]
+    if not geometry:
+        return ""
+    return f" data-variants='{json.dumps(geometry)}'"
+
 
-    secure_id = f"{image_id}_{layer}"
+def _single_image_html(
+    src, img_attrs, use_distortion, hue_rotation, natural_width, natural_height, srcset_attrs=""
+):
+    """render_single_image markup for an escaped URL and lazy-classed attrs."""
     style = _distortion_filter_style(use_distortion, hue_rotation)
     style_attr = f' style="{style}"' if style else ""
 
@@ -142,13 +237,36 @@ def render_single_image(
     html = f"""
 <div class="image-stack" data-layout="single"{wrapper_natural}>
   <img src="data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///ywAAAAAAQABAAACAUwAOw=="
-       data-src="{escape(get_secure_image_url(secure_id, request))}"
+       data-src="{src}"{srcset_attrs}
        loading="lazy"{style_attr} {img_attrs}{natural_attrs}>
 </div>
 """
     return mark_safe(html)
 
 
+def render_pending_image(*, img_attrs="", natural_width=None, natural_height=None):
+    """
+    Render a placeholder while derivatives are still being generated.
+
+    Uses the same wrapper contract as the real renderers, but the <img> has no
+    data-src, so lazy loaders leave it alone. data-state="pending" lets pages
+    style or poll for it.
+    """
+    wrapper_natural = ""
+    if natural_width is not None:
+        wrapper_natural += f' data-natural-width="{natural_width}"'
+    if natural_height is not None:
+        wrapper_natural += f' data-natural-height="{natural_height}"'
+
+    html = f"""
+<div class="image-stack" data-layout="single" data-state="pending"{wrapper_natural}>
+  <img src="data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///ywAAAAAAQABAAACAUwAOw=="
+       alt="" {img_attrs}>
+</div>
+"""
+    return mark_safe(html)
+
+
 def render_image_stack(
     image_id,
     request,
@@ -164,6 +282,8 @@ def render_image_stack(
     height_attr=None,
     breakpoints=None,
     parent_size=None,
+    variants=None,
+    sizes=None,
 ):
     """
     Render the two-layer split stack.
@@ -171,28 +291,65 @@ def render_image_stack(
     If use_distortion=True, applies the reversal filter.
     If use_distortion=False, no filter is applied.
 
+    ``variants`` is the instance's derivative_manifest; when given, both
+    layers get data-srcset candidates and .tile-meta gets their geometry
+    (data-variants). The lazy loader picks one width per stack and loads it on
+    both layers, quantizing to that variant's tile size.
+
     IMPORTANT:
       - data-natural-width / data-natural-height are emitted on BOTH:
         (1) the wrapper .image-stack (for scripts that query the container)
         (2) the top image (backward compatibility)
     """
+    src_1 = escape(get_secure_image_url(f"{image_id}_1", request))
+    src_2 = escape(get_secure_image_url(f"{image_id}_2", request))
+    return _image_stack_html(
+        src_1,
+        src_2,
+        tile_size,
+        width,
+        height,
+        hue_rotation,
+        use_distortion=use_distortion,
+        top_img_attrs=add_lazy_class(top_img_attrs),
+        wrapper_attrs=wrapper_attrs,
+        meta_attrs=_stack_meta_attrs(width_attr, height_attr, breakpoints, parent_size),
+        srcset_1=_srcset_attrs(src_1, width, _variant_srcs(image_id, 1, variants, request), sizes),
+        srcset_2=_srcset_attrs(src_2, width, _variant_srcs(image_id, 2, variants, request), sizes),
+        variants_attr=_variants_attr(variants),
+    )
+
+
+def _stack_meta_attrs(width_attr, height_attr, breakpoints, parent_size):
+    """The .tile-meta attributes that do not depend on the photo (minus tile size)."""
     breakpoints_json = json.dumps(breakpoints or [])
-    top_img_attrs = add_lazy_class(top_img_attrs)
-
-    meta_attrs = [
-        f"data-tile-size='{tile_size}'",
-        f"data-breakpoints='{breakpoints_json}'",
-    ]
+    meta_attrs = [f"data-breakpoints='{breakpoints_json}'"]
     if width_attr is not None:
         meta_attrs.append(f"data-width='{width_attr}'")
     if height_attr is not None:
         meta_attrs.append(f"data-height='{height_attr}'")
     if parent_size is not None:
         meta_attrs.append(f"data-parent-size='{parent_size}'")
+    return " ".join(meta_attrs)
 
-    image_id_1 = str(image_id) + "_1"
-    image_id_2 = str(image_id) + "_2"
 
+def _image_stack_html(
+    src_1,
+    src_2,
+    tile_size,
+    width,
+    height,
+    hue_rotation,
+    *,
+    use_distortion,
+    top_img_attrs,
+    wrapper_attrs,
+    meta_attrs,
+    srcset_1="",
+    srcset_2="",
+    variants_attr="",
+):
+    """render_image_stack markup for escaped URLs and lazy-classed attrs."""
     style = _distortion_filter_style(use_distortion, hue_rotation)
     style_attr = f'style="{style}"' if style else ""
 
@@ -205,12 +362,234 @@ def render_image_stack(
     html = f"""
 <div class="image-stack" data-layout="stack"{wrapper_natural} {wrapper_attrs}>
   <img src="data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///ywAAAAAAQABAAACAUwAOw=="
-       data-src="{escape(get_secure_image_url(image_id_1, request))}"
+       data-src="{src_1}"{srcset_1}
        loading="lazy" {style_attr} class="lazy">
   <img src="data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///ywAAAAAAQABAAACAUwAOw=="
-       data-src="{escape(get_secure_image_url(image_id_2, request))}"
+       data-src="{src_2}"{srcset_2}
        loading="lazy" {style_attr} {top_img_attrs} data-natural-width="{width}" data-natural-height="{height}">
-  <div class="tile-meta" {" ".join(meta_attrs)} hidden></div>
+  <div class="tile-meta" data-tile-size='{tile_size}'{variants_attr} {meta_attrs} hidden></div>
 </div>
 """
-    return mark_safe(html)
\ No newline at end of file
+    return mark_safe(html)
+
+
+# Slot markers; the random part keeps attribute values from forging one
+_SLOT_NONCE = secrets.token_hex(8)
+_SLOT_RE = re.compile(f"\x00{_SLOT_NONCE}:(\\d+)\x00")
+
+
+class ImageFragment:
+    """
+    One photo's rendered markup with its layer URLs cut out as slots.
+
+    ``parts`` are the static pieces around the slots and slot ``i`` takes the
+    URL of ``image_ids[slots[i]]``; an id can fill several slots (the
+    full-size src is also the last data-srcset candidate).
+    """
+
+    __slots__ = ("parts", "slots", "image_ids")
+
+    def __init__(self, html, image_ids=()):
+        pieces = _SLOT_RE.split(html)
+        self.parts = tuple(pieces[::2])
+        self.slots = tuple(int(index) for index in pieces[1::2])
+        self.image_ids = tuple(image_ids)
+
+    def fill(self, urls) -> str:
+        """The markup with ``urls`` (escaped, in image_ids order) in the slots."""
+        parts = self.parts
+        html = [parts[0]]
+        for index, part in zip(self.slots, parts[1:]):
+            html.append(urls[index])
+            html.append(part)
+        return "".join(html)
+
+
+# Keys hold every value the markup depends on, so entries never go stale
+fragment_cache = LocalLRU(
+    maxsize=getattr(settings, "CRYPTPIX_FRAGMENT_CACHE_SIZE", 2048), ttl=float("inf")
+)
+
+
+def _photo_image_ref(photo) -> str:
+    """get_image_ref for CryptPix model instances; the legacy bare pk for other photo objects."""
+    model = type(photo)
+    if hasattr(model, "_meta") and get_cryptpix_model(get_model_key(model)) is model:
+        return get_image_ref(photo)
+    # Resolved by secure_image_view's per-model scan
+    return str(getattr(photo, "pk", None))
+
+
+def photo_fragment_key(photo):
+    """The photo values its markup depends on: image ref, layout and derivative version."""
+    return (
+        _photo_image_ref(photo),
+        layers_renderable(photo),
+        bool(getattr(photo, "use_split", False)),
+        bool(getattr(photo, "use_distortion", False)),
+        getattr(photo, "tile_size", None),
+        getattr(photo, "image_width", None),
+        getattr(photo, "image_height", None),
+        getattr(photo, "hue_rotation", None),
+        tuple(
+            (
+                variant["width"],
+                variant.get("height"),
+                variant.get("tile_size"),
+                bool(variant.get("layer_1")),
+                bool(variant.get("layer_2")),
+            )
+            for variant in getattr(photo, "derivative_manifest", None) or ()
+        ),
+    )
+
+
+def build_image_fragment(
+    photo,
+    *,
+    img_attrs="",
+    width_attr=None,
+    height_attr=None,
+    breakpoints=None,
+    parent_size=None,
+    sizes=None,
+):
+    """
+    Render a photo as {% cryptpix_image %} does (pending placeholder, single
+    image or stack), with slots instead of layer URLs.
+
+    ``img_attrs`` is the already-escaped passthrough attribute string.
+    """
+    width = getattr(photo, "image_width", None)
+    height = getattr(photo, "image_height", None)
+
+    if not layers_renderable(photo):
+        return ImageFragment(
+            render_pending_image(img_attrs=img_attrs, natural_width=width, natural_height=height)
+        )
+
+    ref = _photo_image_ref(photo)
+    variants = getattr(photo, "derivative_manifest", None) or ()
+    use_distortion = bool(getattr(photo, "use_distortion", False))
+    hue_rotation = getattr(photo, "hue_rotation", None)
+    image_ids = []
+
+    def slot(image_id):
+        image_ids.append(image_id)
+        return f"\x00{_SLOT_NONCE}:{len(image_ids) - 1}\x00"
+
+    def layer_srcs(layer):
+        src = slot(f"{ref}_{layer}")
+        variant_srcs = [
+            (slot(f"{ref}_{layer}@{variant['width']}"), variant["width"])
+            for variant in variants
+            if variant.get(f"layer_{layer}")
+        ]
+        return src, _srcset_attrs(src, width, variant_srcs, sizes)
+
+    if getattr(photo, "use_split", False):
+        src_1, srcset_1 = layer_srcs(1)
+        src_2, srcset_2 = layer_srcs(2)
+        html = _image_stack_html(
+            src_1,
+            src_2,
+            getattr(photo, "tile_size", None),
+            width,
+            height,
+            hue_rotation,
+            use_distortion=use_distortion,
+            top_img_attrs=add_lazy_class(img_attrs),
+            wrapper_attrs="",
+            meta_attrs=_stack_meta_attrs(width_attr, height_attr, breakpoints, parent_size),
+            srcset_1=srcset_1,
+            srcset_2=srcset_2,
+            variants_attr=_variants_attr(variants),
+        )
+    else:
+        src, srcset_attrs = layer_srcs(1)
+        html = _single_image_html(
+            src, add_lazy_class(img_attrs), use_distortion, hue_rotation, width, height, srcset_attrs
+        )
+    return ImageFragment(html, image_ids)
+
+
+def get_image_fragment(photo, tag_key, get_options):
+    """
+    The cached ImageFragment of ``photo`` rendered with tag arguments ``tag_key``.
+
+    On a miss the fragment is built from ``get_options()``, the keyword
+    arguments of build_image_fragment, so callers can keep parsing their
+    arguments off the hit path.
+    """
+    try:
+        key = (photo_fragment_key(photo), tag_key)
+        fragment = fragment_cache.get(key)
+    except TypeError:
+        # Unhashable tag argument values: render without the cache
+        key = fragment = None
+    if fragment is None:
+        fragment = build_image_fragment(photo, **get_options())
+        if key is not None:
+            fragment_cache.set(key, fragment)
+    return fragment
+
+
+def render_image_fragments(fragments, request):
+    """
+    Fill the fragments' slots with freshly signed URLs and join them.
+
+    The binding key is looked up once, the URL is reversed once and all
+    tokens are signed in one loop; pending placeholders need neither.
+    """
+    image_ids = [image_id for fragment in fragments for image_id in fragment.image_ids]
+    if not image_ids:
+        return mark_safe("".join(fragment.parts[0] for fragment in fragments))
+
+    prefix, suffix = _secure_image_url_affixes()
+    # Tokens contain nothing escape() would change
+    prefix, suffix = escape(prefix), escape(suffix)
+    tokens = sign_image_tokens(image_ids, get_binding_key(request))
+    urls = [f"{prefix}{token}{suffix}" for token in tokens]
+
+    html = []
+    offset = 0
+    for fragment in fragments:
+        count = len(fragment.image_ids)
+        html.append(fragment.fill(urls[offset:offset + count]))
+        offset += count
+    return mark_safe("".join(html))
+
+
+def render_image_stacks(
+    photos,
+    request,
+    *,
+    img_attrs="",
+    width_attr=None,
+    height_attr=None,
+    breakpoints=None,
+    parent_size=None,
+    sizes=None,
+):
+    """
+    Render many photos in one pass, as consecutive {% cryptpix_image %} tags would.
+
+    The output is exactly the concatenation of the single-image renderers
+    (pending placeholder, single image or stack per photo). Each photo's
+    markup comes from the fragment cache, and all tokens are signed at once
+    (see render_image_fragments).
+
+    ``img_attrs`` is the already-escaped passthrough attribute string.
+    """
+    options = {
+        "img_attrs": img_attrs,
+        "width_attr": width_attr,
+        "height_attr": height_attr,
+        "breakpoints": breakpoints,
+        "parent_size": parent_size,
+        "sizes": sizes,
+    }
+    # The meta attributes stand in for the (unhashable) breakpoints
+    tag_key = (img_attrs, _stack_meta_attrs(width_attr, height_attr, breakpoints, parent_size), sizes)
+    fragments = [get_image_fragment(photo, tag_key, lambda: options) for photo in photos]
+    return render_image_fragments(fragments, request)
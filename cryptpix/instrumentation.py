@@ -0,0 +1,146 @@
+"""Per-stage timing and byte-count hooks for generation and serving."""
+
+from __future__ import annotations
+
+import logging
+import time
+from typing import Callable, Optional
+
+
+logger = logging.getLogger(__name__)
+
+StageHook = Callable[[str, float, Optional[int], dict], None]
+
+# Replaced, never mutated, so stages can iterate without a lock
+_hooks: tuple = ()
+
+
+def add_stage_hook(hook: StageHook) -> None:
+    """Call ``hook(stage, seconds, nbytes, info)`` after every instrumented stage."""
+    global _hooks
+    if hook not in _hooks:
+        _hooks = _hooks + (hook,)
+
+
+def remove_stage_hook(hook: StageHook) -> None:
+    global _hooks
+    _hooks = tuple(registered for registered in _hooks if registered != hook)
+
+
+def instrumentation_enabled() -> bool:
+    """True when at least one stage hook is registered."""
+    return bool(_hooks)
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def record(self, nbytes=None, **info) -> None:
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("name", "nbytes", "info", "_hooks", "_start")
+
+    def __init__(self, name, hooks, info):
+        self.name = name
+        self.nbytes = None
+        self.info = info
+        self._hooks = hooks
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        if exc_type is not None:
+            self.info["error"] = exc_type.__name__
+        for hook in self._hooks:
+            try:
+                hook(self.name, seconds, self.nbytes, self.info)
+            except Exception:
+                logger.exception("CryptPix: instrumentation hook %r failed", hook)
+        return False
+
+    def record(self, nbytes=None, **info) -> None:
+        """Attach a byte count and/or extra info to the stage report."""
+        if nbytes is not None:
+            self.nbytes = (self.nbytes or 0) + nbytes
+        self.info.update(info)
+
+
+def stage(name: str, **info):
+    """Context manager timing one stage; ``.record(nbytes, **info)`` adds details."""
+    hooks = _hooks
+    if not hooks:
+        return _NULL_STAGE
+    return _Stage(name, hooks, info)
+
+
+class LoggingHook:
+    """Logs every stage as one structured record.
+
+    The message is human readable; the same values are attached as
+    ``record.cryptpix`` (a dict) for JSON log formatters.
+    """
+
+    def __init__(self, logger_name: str = "cryptpix.stages", level: int = logging.INFO):
+        self.logger = logging.getLogger(logger_name)
+        self.level = level
+
+    def __call__(self, stage, seconds, nbytes, info):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        data = dict(info, stage=stage, ms=round(seconds * 1000, 3))
+        if nbytes is not None:
+            data["bytes"] = nbytes
+        self.logger.log(
+            self.level,
+            "cryptpix %s %.1fms%s",
+            stage,
+            seconds * 1000,
+            f" {nbytes}B" if nbytes is not None else "",
+            extra={"cryptpix": data},
+        )
+
+
+class PrometheusHook:
+    """Exports stages as Prometheus metrics (needs ``prometheus_client``).
+
+      - ``{namespace}_stage_seconds{stage}``: histogram of stage durations
+      - ``{namespace}_stage_bytes_total{stage}``: bytes encoded/written/...
+      - ``{namespace}_stage_errors_total{stage}``: failed stages
+
+    Create it once per process (metric names must be unique per registry).
+    """
+
+    def __init__(self, namespace: str = "cryptpix", registry=None):
+        from prometheus_client import REGISTRY, Counter, Histogram
+
+        registry = registry if registry is not None else REGISTRY
+        self.seconds = Histogram(
+            f"{namespace}_stage_seconds", "CryptPix stage duration", ["stage"], registry=registry
+        )
+        self.bytes = Counter(
+            f"{namespace}_stage_bytes", "CryptPix stage output size", ["stage"], registry=registry
+        )
+        self.errors = Counter(
+            f"{namespace}_stage_errors", "CryptPix failed stages", ["stage"], registry=registry
+        )
+
+    def __call__(self, stage, seconds, nbytes, info):
+        self.seconds.labels(stage).observe(seconds)
+        if nbytes:
+            self.bytes.labels(stage).inc(nbytes)
+        if "error" in info:
+            self.errors.labels(stage).inc()
@@ -15,6 +15,8 @@ class CryptPixAdminMixin:
         "image_width",
         "image_height",
         "hue_rotation",
+        "processing_state",
+        "derivative_manifest",
         "image_layer_1_preview",
         "image_layer_2_preview",
     )
@@ -1,9 +1,72 @@
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from django.core.files.base import ContentFile
-from django.db import models
+from django.conf import settings
+from django.core.files.base import File
+from django.db import models, router, transaction
+from django.db.models import F, Q
 
-from cryptpix import process_and_split_image, distort_image
+from cryptpix.cache import invalidate_layer_cache, variant_widths
+from cryptpix.core import (
+    DEFAULT_LAYER_ENCODING,
+    build_cryptpix_layers,
+    build_cryptpix_pyramid,
+    content_digest,
+    layer_geometry,
+    open_source_image,
+)
+from cryptpix.instrumentation import stage
+
+
+_upload_executor = None
+_upload_executor_lock = threading.Lock()
+
+
+def _get_upload_executor():
+    """Thread pool for derivative uploads (CRYPTPIX_UPLOAD_THREADS, default 4), or None."""
+    global _upload_executor
+    workers = getattr(settings, "CRYPTPIX_UPLOAD_THREADS", 4)
+    if workers <= 1:
+        return None
+    with _upload_executor_lock:
+        if _upload_executor is None:
+            _upload_executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="cryptpix-upload"
+            )
+        return _upload_executor
+
+
+def _store_file(storage, path, buffer, field_name):
+    with stage("store", field=field_name) as timing:
+        # The buffer is read in chunks by the storage; no bytes copy is made.
+        # Storage may pick a different name if the path is taken.
+        name = storage.save(path, File(buffer, name=os.path.basename(path)))
+        timing.record(buffer.getbuffer().nbytes)
+    return name
+
+
+class ProcessingState(models.TextChoices):
+    PENDING = "pending", "Pending"
+    PROCESSING = "processing", "Processing"
+    READY = "ready", "Ready"
+    FAILED = "failed", "Failed"
+
+
+# Fields set by derivative generation rather than by the application
+CRYPTPIX_DERIVATIVE_FIELDS = (
+    "image_layer_1",
+    "image_layer_2",
+    "tile_size",
+    "image_width",
+    "image_height",
+    "hue_rotation",
+    "derivative_manifest",
+    "derivative_digest",
+    "processing_state",
+)
 
 
 class CryptPixModelMixin(models.Model):
@@ -29,104 +92,540 @@ class CryptPixModelMixin(models.Model):
     # Distortion metadata (only meaningful when use_distortion=True)
     hue_rotation = models.PositiveSmallIntegerField(editable=False, null=True, blank=True)
 
+    # Downscaled variants generated from cryptpix_widths:
+    # [{"width", "height", "tile_size", "layer_1", "layer_2"}, ...], ascending width
+    derivative_manifest = models.JSONField(default=list, editable=False, blank=True)
+
+    # cryptpix.models.CryptPixBlob digest when the layers are shared (cryptpix_deduplicate)
+    derivative_digest = models.CharField(
+        max_length=64, blank=True, default="", editable=False, db_index=True
+    )
+
+    # Derivative generation state ("ready" once layers exist; see cryptpix_generation_mode)
+    processing_state = models.CharField(
+        max_length=16,
+        choices=ProcessingState.choices,
+        default=ProcessingState.READY,
+        editable=False,
+        db_index=True,
+    )
+
     # Configurable attributes
     cryptpix_source_field = "image"
+    # Bytes of working memory for strip-based (streaming) generation; None keeps
+    # the whole image in memory. See cryptpix.streaming.
+    cryptpix_memory_budget = None
+    # cryptpix.core.LayerEncoding for stored layers; None means default PNG.
+    cryptpix_layer_encoding = None
+    # "sync" generates layers inside save(); "deferred" saves the row as pending and
+    # generates layers after commit on the CRYPTPIX_TASK_BACKEND (see cryptpix.tasks);
+    # "lazy" only records the layer geometry and generates on the first layer request
+    # (see cryptpix.lazy).
+    cryptpix_generation_mode = "sync"
+    # Widths of smaller variants to generate next to the full-size layers, e.g.
+    # (320, 640, 1280); templates then emit srcset so clients pick a resolution.
+    cryptpix_widths = ()
+    # Share layer files between rows whose sources decode to the same pixels and
+    # use the same generation options (reference counted in CryptPixBlob).
+    cryptpix_deduplicate = False
+    # Longest side of the stored layers in pixels; larger sources are downscaled
+    # while decoding (JPEG draft mode) before any other work. None keeps full size.
+    cryptpix_max_dimension = None
 
     class Meta:
         abstract = True
 
-    def _save_derivative_to_field(self, field, base_filename: str, suffix: str, content: bytes) -> str:
-        filename = f"{base_filename}_{suffix}.png"
-        path = field.field.generate_filename(self, filename)
-        field.storage.save(path, ContentFile(content))
-        field.name = path
-        return path
+    def _store_cryptpix_files(self, files) -> list:
+        """Save [(field_name, filename, BytesIO), ...] to storage; returns the stored names.
 
-    def save(self, *args, **kwargs):
-        # Save first to ensure PK exists (upload_to may depend on instance state)
-        if self.pk is None:
-            super().save(*args, **kwargs)
+        Several files are uploaded concurrently on the CRYPTPIX_UPLOAD_THREADS
+        pool. If any upload fails, the ones that succeeded are deleted again
+        before the error is raised.
+        """
+        jobs = []
+        for field_name, filename, buffer in files:
+            field = self._meta.get_field(field_name)
+            jobs.append((field.storage, field.generate_filename(self, filename), buffer, field_name))
+
+        executor = _get_upload_executor() if len(jobs) > 1 else None
+        if executor is None:
+            return [_store_file(*job) for job in jobs]
+
+        futures = [executor.submit(_store_file, *job) for job in jobs]
+        names, error = [], None
+        for future in futures:
+            try:
+                names.append(future.result())
+            except Exception as exc:
+                names.append(None)
+                error = error or exc
+        if error is not None:
+            for (storage, *_), name in zip(jobs, names):
+                if name is not None:
+                    storage.delete(name)
+            raise error
+        return names
 
+    def _needs_cryptpix_derivatives(self) -> bool:
         base_field = getattr(self, self.cryptpix_source_field, None)
+        return bool(base_field) and not self.image_layer_1
 
-        # Only generate derivatives once (no regeneration/toggle changes supported)
-        if base_field and hasattr(base_field, "path") and not self.image_layer_1:
-            base_filename = os.path.splitext(os.path.basename(base_field.name))[0]
+    def _cryptpix_layers_need_pk(self) -> bool:
+        """Whether the layer fields' upload_to may depend on the saved row."""
+        return any(
+            callable(self._meta.get_field(field_name).upload_to)
+            for field_name in ("image_layer_1", "image_layer_2")
+        )
 
-            hue_rotation = None
+    def prepare_cryptpix_lazy(self) -> None:
+        """Record what templates need before lazy generation: geometry and hue rotation.
 
-            # Start from the source image on disk
-            if self.use_distortion:
-                working_image, hue_rotation = distort_image(base_field.path)
-            else:
-                # If we are not distorting, we still need a PIL image object for split/non-split saves.
-                # Reuse distort_image's loader pattern by calling PIL directly here.
-                from PIL import Image  # local import to keep import surface small
+        Only the source header is read. Generation later produces exactly this
+        geometry and reuses the rotation.
+        """
+        base_field = getattr(self, self.cryptpix_source_field)
+        with base_field.open("rb"):
+            self.tile_size, self.image_width, self.image_height = layer_geometry(
+                base_field, use_split=self.use_split, max_dimension=self.cryptpix_max_dimension
+            )
+        self.hue_rotation = random.randint(30, 180) if self.use_distortion else None
+        self.processing_state = ProcessingState.PENDING
+
+    def open_cryptpix_source(self, max_dimension=None):
+        """Decode the source image through its field's storage (local or remote)."""
+        base_field = getattr(self, self.cryptpix_source_field)
+        with base_field.open("rb"):
+            with stage("decode") as timing:
+                source = open_source_image(base_field, max_dimension)
+                source.load()
+                timing.record(width=source.width, height=source.height)
+        return source
+
+    def get_cryptpix_generation_options(self) -> dict:
+        """Keyword arguments for cryptpix.core.build_cryptpix_layers for this instance."""
+        return dict(
+            use_distortion=self.use_distortion,
+            use_split=self.use_split,
+            memory_budget=self.cryptpix_memory_budget,
+            encoding=self.cryptpix_layer_encoding or DEFAULT_LAYER_ENCODING,
+            max_dimension=self.cryptpix_max_dimension,
+        )
+
+    def generate_cryptpix_derivatives(self) -> list:
+        """Build and store the derivative layers for the current source image.
+
+        Sets the layer fields and metadata on the instance but does not save
+        the row. Returns the field names that need to be persisted, and sends
+        cryptpix.signals.derivatives_generated.
+        """
+        from cryptpix.signals import derivatives_generated
+
+        started = time.perf_counter()
+        with stage("generate", model=self._meta.label) as timing:
+            update_fields, deduplicated = self._generate_cryptpix_derivatives()
+            timing.record(deduplicated=deduplicated)
+
+        derivatives_generated.send(
+            sender=type(self),
+            instance=self,
+            update_fields=update_fields,
+            deduplicated=deduplicated,
+            seconds=time.perf_counter() - started,
+        )
+        return update_fields
+
+    def _generate_cryptpix_derivatives(self):
+        """(update_fields, deduplicated) for generate_cryptpix_derivatives."""
+        # Decode (and downscale) once for the digest, the layers and the variants
+        options = self.get_cryptpix_generation_options()
+        source = self.open_cryptpix_source(options["max_dimension"])
+
+        lazy = self.cryptpix_generation_mode == "lazy"
+        if lazy:
+            # Pages rendered before generation already use this rotation
+            options["hue_rotation"] = self.hue_rotation
+
+        digest = None
+        # Adopted layers would bring their own hue rotation, so lazy rows never share
+        if self.cryptpix_deduplicate and not lazy:
+            digest = content_digest(source, **self._get_cryptpix_digest_params(options))
+            update_fields = self._adopt_cryptpix_blob(digest)
+            if update_fields is not None:
+                return update_fields, True
+
+        layers = build_cryptpix_layers(source, **options)
+        update_fields = self.apply_cryptpix_layers(layers)
+
+        if self.cryptpix_widths:
+            variants = build_cryptpix_pyramid(
+                source, self.cryptpix_widths, **self.get_cryptpix_pyramid_options()
+            )
+            update_fields += self.apply_cryptpix_variants(variants)
+
+        if digest is not None:
+            update_fields += self._register_cryptpix_blob(digest)
+        return update_fields, False
+
+    def _get_cryptpix_digest_params(self, options) -> dict:
+        # Everything that changes the stored pixels or files; memory_budget does not
+        params = dict(
+            use_distortion=options["use_distortion"],
+            use_split=options["use_split"],
+            encoding=repr(options["encoding"]),
+            widths=tuple(sorted(set(self.cryptpix_widths))),
+        )
+        if options["max_dimension"]:
+            # Only when set, so digests stored before the option existed still match
+            params["max_dimension"] = options["max_dimension"]
+        return params
+
+    def _use_cryptpix_blob(self, blob) -> list:
+        """Point this instance at a blob's files and metadata."""
+        self.image_layer_1 = blob.layer_1
+        self.image_layer_2 = blob.layer_2 or None
+        self.tile_size = blob.tile_size
+        self.image_width = blob.image_width
+        self.image_height = blob.image_height
+        self.hue_rotation = blob.hue_rotation
+        self.derivative_manifest = blob.derivative_manifest
+        self.derivative_digest = blob.digest
+        self.processing_state = ProcessingState.READY
+        return [
+            "image_layer_1",
+            "image_layer_2",
+            "tile_size",
+            "image_width",
+            "image_height",
+            "hue_rotation",
+            "derivative_manifest",
+            "derivative_digest",
+            "processing_state",
+        ]
+
+    def _adopt_cryptpix_blob(self, digest):
+        """Reuse stored layers for ``digest``; returns update_fields, or None if there are none."""
+        from cryptpix.models import CryptPixBlob
+
+        with transaction.atomic():
+            # Taking the reference first keeps a concurrent release from deleting the files
+            if not CryptPixBlob.objects.filter(digest=digest).update(refcount=F("refcount") + 1):
+                return None
+            blob = CryptPixBlob.objects.get(digest=digest)
+        return self._use_cryptpix_blob(blob)
+
+    def _register_cryptpix_blob(self, digest) -> list:
+        """Record freshly generated layers as the shared files for ``digest``."""
+        from cryptpix.models import CryptPixBlob
+
+        blob, created = CryptPixBlob.objects.get_or_create(
+            digest=digest,
+            defaults=dict(
+                refcount=1,
+                layer_1=self.image_layer_1.name,
+                layer_2=self.image_layer_2.name if self.image_layer_2 else "",
+                tile_size=self.tile_size,
+                image_width=self.image_width,
+                image_height=self.image_height,
+                hue_rotation=self.hue_rotation,
+                derivative_manifest=self.derivative_manifest,
+            ),
+        )
+        if not created:
+            # Another row stored the same derivatives meanwhile: share those
+            if CryptPixBlob.objects.filter(pk=blob.pk).update(refcount=F("refcount") + 1):
+                own = self.get_cryptpix_file_names()
+                update_fields = self._use_cryptpix_blob(blob)
+                for field_name, name in own - blob.file_names():
+                    self._meta.get_field(field_name).storage.delete(name)
+                return update_fields
+            # ...unless it was released in between; keep our own files unshared
+            return []
+
+        self.derivative_digest = digest
+        return ["derivative_digest"]
+
+    def get_cryptpix_pyramid_options(self) -> dict:
+        """Keyword arguments for cryptpix.core.build_cryptpix_pyramid, once layers exist."""
+        return dict(
+            use_distortion=self.use_distortion,
+            use_split=self.use_split,
+            hue_rotation=self.hue_rotation,
+            encoding=self.cryptpix_layer_encoding or DEFAULT_LAYER_ENCODING,
+            max_dimension=self.cryptpix_max_dimension,
+            memory_budget=self.cryptpix_memory_budget,
+        )
 
-                working_image = Image.open(base_field.path).convert("RGBA")
+    def apply_cryptpix_variants(self, variants) -> list:
+        """Store a build_cryptpix_pyramid() result and record it in derivative_manifest.
 
-            if self.use_split:
-                # Split mode: always produces two layers
-                _, layer1_io, layer2_io, tile_size, width, height = process_and_split_image(working_image)
+        Replaces the previous manifest (its files are not deleted here).
+        Returns the field names that need to be persisted.
+        """
+        encoding = self.cryptpix_layer_encoding or DEFAULT_LAYER_ENCODING
+        base_field = getattr(self, self.cryptpix_source_field)
+        base_filename = os.path.splitext(os.path.basename(base_field.name))[0]
 
-                self._save_derivative_to_field(
-                    self.image_layer_1, base_filename, "layer1", layer1_io.getvalue()
+        manifest, slots, files = [], [], []
+        for _, (layer1_io, layer2_io, tile_size, width, height, _) in variants:
+            entry = {"width": width, "height": height, "tile_size": tile_size}
+            for layer, layer_io in ((1, layer1_io), (2, layer2_io)):
+                entry[f"layer_{layer}"] = None
+                if layer_io is not None:
+                    slots.append((entry, f"layer_{layer}"))
+                    files.append((
+                        f"image_layer_{layer}",
+                        f"{base_filename}_layer{layer}_w{width}.{encoding.extension}",
+                        layer_io,
+                    ))
+            manifest.append(entry)
+
+        # Every variant file is uploaded concurrently
+        for (entry, key), name in zip(slots, self._store_cryptpix_files(files)):
+            entry[key] = name
+
+        self.derivative_manifest = manifest
+        return ["derivative_manifest"]
+
+    def get_cryptpix_variant_file(self, layer: int, width: int):
+        """FieldFile for a layer of the stored variant with this width, or None."""
+        for entry in self.derivative_manifest or ():
+            if entry.get("width") == width:
+                name = entry.get(f"layer_{layer}")
+                if not name:
+                    return None
+                field = self._meta.get_field(f"image_layer_{layer}")
+                return field.attr_class(self, field, name)
+        return None
+
+    def get_cryptpix_file_names(self) -> set:
+        """(field_name, storage name) of every stored derivative, variants included."""
+        names = {
+            (field_name, getattr(self, field_name).name)
+            for field_name in ("image_layer_1", "image_layer_2")
+            if getattr(self, field_name)
+        }
+        for entry in self.derivative_manifest or ():
+            for layer in (1, 2):
+                if entry.get(f"layer_{layer}"):
+                    names.add((f"image_layer_{layer}", entry[f"layer_{layer}"]))
+        return names
+
+    def apply_cryptpix_layers(self, layers) -> list:
+        """Store a build_cryptpix_layers() result on this instance.
+
+        Writes the layer files to storage and sets metadata, without saving
+        the row. A reference to shared (deduplicated) layers is released.
+        Returns the field names that need to be persisted.
+        """
+        from cryptpix.models import CryptPixBlob
+
+        layer1_io, layer2_io, tile_size, width, height, hue_rotation = layers
+        encoding = self.cryptpix_layer_encoding or DEFAULT_LAYER_ENCODING
+
+        base_field = getattr(self, self.cryptpix_source_field)
+        base_filename = os.path.splitext(os.path.basename(base_field.name))[0]
+
+        files = [("image_layer_1", f"{base_filename}_layer1.{encoding.extension}", layer1_io)]
+        if self.use_split:
+            # Split mode: always produces two layers
+            files.append(("image_layer_2", f"{base_filename}_layer2.{encoding.extension}", layer2_io))
+        names = self._store_cryptpix_files(files)
+
+        # The new layers belong to this row alone. Replaced layers shared through
+        # a blob may only be deleted once this was its last reference; callers
+        # deleting replaced files check _cryptpix_replaced_owned.
+        self._cryptpix_replaced_owned = True
+        if self.derivative_digest:
+            self._cryptpix_replaced_owned = CryptPixBlob.release(self.derivative_digest)
+            self.derivative_digest = ""
+
+        self.image_layer_1 = names[0]
+        if self.use_split:
+            self.image_layer_2 = names[1]
+        else:
+            # Non-split mode: single processed image in layer_1, keep layer_2 empty
+            if self.image_layer_2 and self._cryptpix_replaced_owned:
+                self.image_layer_2.delete(save=False)
+            self.image_layer_2 = None
+
+        # tile_size is None when not split
+        self.tile_size = tile_size
+        self.image_width = width
+        self.image_height = height
+
+        # Set/clear distortion metadata
+        self.hue_rotation = hue_rotation if self.use_distortion else None
+
+        self.processing_state = ProcessingState.READY
+
+        update_fields = [
+            "use_split",
+            "use_distortion",
+            "image_layer_1",
+            "image_layer_2",
+            "tile_size",
+            "image_width",
+            "image_height",
+            "hue_rotation",
+            "derivative_digest",
+            "processing_state",
+        ]
+
+        # Keep existing behavior: if the concrete model has a thumbnail field, let it be updated too
+        if hasattr(self, "thumbnail") and self.thumbnail:
+            update_fields.append("thumbnail")
+
+        return update_fields
+
+    def _commit_cryptpix_source(self):
+        """Store the source the way FileField.pre_save would, so it can be read before the INSERT.
+
+        Returns the name it had before, or None if it was already stored.
+        """
+        base_field = getattr(self, self.cryptpix_source_field)
+        if base_field._committed:
+            return None
+        uploaded_name = base_field.name
+        base_field.save(base_field.name, base_field.file, save=False)
+        return uploaded_name
+
+    def _discard_cryptpix_files(self, uploaded_name) -> None:
+        """Undo the storage writes of a first save that failed before its INSERT committed.
+
+        Drops the blob reference (deleting the layers only with the last one),
+        resets the generated fields and, if this save stored the source
+        (``uploaded_name`` from _commit_cryptpix_source), deletes it and
+        puts the upload back so the instance can be saved again.
+        """
+        from cryptpix.models import CryptPixBlob
+
+        digest = self.derivative_digest
+        if not digest or CryptPixBlob.release(digest):
+            for field_name, name in self.get_cryptpix_file_names():
+                self._meta.get_field(field_name).storage.delete(name)
+        for field_name in CRYPTPIX_DERIVATIVE_FIELDS:
+            setattr(self, field_name, self._meta.get_field(field_name).get_default())
+
+        if uploaded_name is not None:
+            base_field = getattr(self, self.cryptpix_source_field)
+            base_field.storage.delete(base_field.name)
+            base_field.name = uploaded_name
+            base_field._committed = False
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._cryptpix_saved_files = instance._cryptpix_file_state()
+        return instance
+
+    def _cryptpix_file_state(self):
+        """The stored names cached layers are read from; None if some are not loaded."""
+        fields = {self.cryptpix_source_field, "image_layer_1", "image_layer_2", "derivative_manifest"}
+        if fields & self.get_deferred_fields():
+            return None
+        source = getattr(self, self.cryptpix_source_field)
+        return source.name, frozenset(self.get_cryptpix_file_names())
+
+    def _cryptpix_kept_fields(self, kwargs) -> dict:
+        """save() kwargs that leave the generated fields as the database has them.
+
+        A loaded row without layers may be out of date: a background job or a
+        lazy request may have generated them since it was read.
+        """
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None:
+            update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+        return {
+            **kwargs,
+            "update_fields": [name for name in update_fields if name not in CRYPTPIX_DERIVATIVE_FIELDS],
+        }
+
+    def _cryptpix_rows_without_layers(self):
+        """This row, while the database still has it without layers."""
+        return type(self)._default_manager.using(self._state.db).filter(
+            Q(image_layer_1="") | Q(image_layer_1__isnull=True), pk=self.pk
+        )
+
+    def save(self, *args, **kwargs):
+        if self.cryptpix_generation_mode == "deferred" and self._needs_cryptpix_derivatives():
+            # Persist the row now; derivatives are generated by a background job.
+            queued = (ProcessingState.PENDING, ProcessingState.PROCESSING)
+            if self._state.adding:
+                enqueue = self.processing_state not in queued
+                if enqueue:
+                    self.processing_state = ProcessingState.PENDING
+                super().save(*args, **kwargs)
+            else:
+                super().save(*args, **self._cryptpix_kept_fields(kwargs))
+                # Re-queue (e.g. after a failure) only if no job got to the row meanwhile
+                enqueue = self.processing_state not in queued and bool(
+                    self._cryptpix_rows_without_layers()
+                    .exclude(processing_state__in=queued)
+                    .update(processing_state=ProcessingState.PENDING)
                 )
-                self._save_derivative_to_field(
-                    self.image_layer_2, base_filename, "layer2", layer2_io.getvalue()
+                if enqueue:
+                    self.processing_state = ProcessingState.PENDING
+
+            if enqueue:
+                from cryptpix.tasks import enqueue_derivative_generation
+
+                model, pk = type(self), self.pk
+                transaction.on_commit(
+                    lambda: enqueue_derivative_generation(model, pk), using=self._state.db
                 )
+            return
 
-                self.tile_size = tile_size
-                self.image_width = width
-                self.image_height = height
+        if self.cryptpix_generation_mode == "lazy" and self._needs_cryptpix_derivatives():
+            if self._state.adding:
+                if self.image_width is None:
+                    self._commit_cryptpix_source()
+                    self.prepare_cryptpix_lazy()
+                super().save(*args, **kwargs)
+                return
 
-            else:
-                # Non-split mode: store a single processed image in layer_1, keep layer_2 empty
-                from io import BytesIO  # local import
-                buf = BytesIO()
-                working_image.save(buf, format="PNG")
-                buf.seek(0)
-
-                self._save_derivative_to_field(
-                    self.image_layer_1, base_filename, "layer1", buf.getvalue()
+            super().save(*args, **self._cryptpix_kept_fields(kwargs))
+            if self.image_width is None:
+                # A row from before lazy mode: record its geometry unless a
+                # request has generated its layers meanwhile
+                self.prepare_cryptpix_lazy()
+                self._cryptpix_rows_without_layers().filter(image_width__isnull=True).update(
+                    tile_size=self.tile_size,
+                    image_width=self.image_width,
+                    image_height=self.image_height,
+                    hue_rotation=self.hue_rotation,
+                    processing_state=self.processing_state,
                 )
+            return
 
-                # Explicitly keep layer 2 empty and clear split metadata
-                if self.image_layer_2:
-                    self.image_layer_2.delete(save=False)
-                self.image_layer_2 = None
-
-                # Set image dimensions from the processed image (working_image is a PIL Image)
-                try:
-                    width, height = working_image.size
-                except Exception:
-                    # If we can't determine size for any reason, keep fields cleared (null)
-                    width = None
-                    height = None
-
-                self.tile_size = None
-                self.image_width = width
-                self.image_height = height
-
-            # Set/clear distortion metadata
-            self.hue_rotation = hue_rotation if self.use_distortion else None
-
-            update_fields = [
-                "use_split",
-                "use_distortion",
-                "image_layer_1",
-                "image_layer_2",
-                "tile_size",
-                "image_width",
-                "image_height",
-                "hue_rotation",
-            ]
-
-            # Keep existing behavior: if the concrete model has a thumbnail field, let it be updated too
-            if hasattr(self, "thumbnail") and self.thumbnail:
-                update_fields.append("thumbnail")
+        if self._state.adding and self._needs_cryptpix_derivatives() and not self._cryptpix_layers_need_pk():
+            # One INSERT: store the source the way pre_save would (the row has no
+            # pk there either), generate, then write the row with its layers
+            uploaded_name = self._commit_cryptpix_source()
+            try:
+                self.generate_cryptpix_derivatives()
+                with transaction.atomic(using=router.db_for_write(type(self), instance=self)):
+                    super().save(*args, **kwargs)
+            except Exception:
+                # Nothing references the stored files without the row
+                self._discard_cryptpix_files(uploaded_name)
+                raise
+            return
 
+        # Save first to ensure the row exists (callable upload_to may depend on it)
+        if self._state.adding:
+            super().save(*args, **kwargs)
+
+        # Only generate derivatives once (no regeneration/toggle changes supported)
+        if self._needs_cryptpix_derivatives():
+            widths = variant_widths(self.derivative_manifest)
+            update_fields = self.generate_cryptpix_derivatives()
             super().save(update_fields=update_fields)
+            invalidate_layer_cache(type(self), self.pk, widths)
             return
 
         super().save(*args, **kwargs)
+        files = self._cryptpix_file_state()
+        if files is None or files != getattr(self, "_cryptpix_saved_files", None):
+            # The source (layer 0) or the layers were replaced
+            invalidate_layer_cache(type(self), self.pk, variant_widths(self.derivative_manifest))
+        self._cryptpix_saved_files = files
@@ -0,0 +1,140 @@
+"""On-first-request derivative generation (cryptpix_generation_mode = "lazy").
+
+Generation is single-flight per image, across threads and processes.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, router, transaction
+
+from .integrations.django import ProcessingState
+from .utils import get_model_key
+
+
+logger = logging.getLogger(__name__)
+
+_POLL_INTERVAL = 0.05
+_RETRY_AFTER_FAILURE = 60
+
+# key -> [lock, holders and waiters]; entries go away with their last user
+_local_locks = {}
+_local_locks_guard = threading.Lock()
+
+
+def _join_local_lock(key):
+    with _local_locks_guard:
+        entry = _local_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+        return entry
+
+
+def _leave_local_lock(key, entry) -> None:
+    with _local_locks_guard:
+        entry[1] -= 1
+        if not entry[1]:
+            del _local_locks[key]
+
+
+def needs_lazy_generation(instance) -> bool:
+    return (
+        getattr(instance, "cryptpix_generation_mode", None) == "lazy"
+        and not instance.image_layer_1
+        and bool(getattr(instance, instance.cryptpix_source_field, None))
+    )
+
+
+def _reload(model, pk):
+    return model._default_manager.filter(pk=pk).first()
+
+
+def _generate(instance, cache, key):
+    model = type(instance)
+    try:
+        # A savepoint inside an outer atomic block (e.g. ATOMIC_REQUESTS), so a
+        # failed save leaves that transaction usable for marking the row FAILED
+        with transaction.atomic(using=router.db_for_write(model, instance=instance)):
+            update_fields = instance.generate_cryptpix_derivatives()
+            instance.save(update_fields=update_fields)
+    except Exception:
+        logger.exception(
+            "CryptPix: lazy generation failed for %s pk=%s", model._meta.label, instance.pk
+        )
+        try:
+            model._default_manager.filter(pk=instance.pk).update(
+                processing_state=ProcessingState.FAILED
+            )
+        except DatabaseError:
+            logger.exception("CryptPix: could not mark pk=%s as failed", instance.pk)
+        # Requests arriving in the next minute fail fast instead of retrying
+        cache.set(f"{key}:failed", 1, _RETRY_AFTER_FAILURE)
+        return None
+    return instance
+
+
+def _release_lock(cache, key, using, generated):
+    connection = transaction.get_connection(using)
+    if generated and connection.in_atomic_block and not connection.needs_rollback:
+        # Other processes only see the layers once the saving transaction
+        # (e.g. ATOMIC_REQUESTS) commits
+        transaction.on_commit(lambda: cache.delete(key), using=using)
+    else:
+        # Nothing new to wait for, or on_commit would never run after a rollback
+        cache.delete(key)
+
+
+def _single_flight(model, pk, cache, key, deadline):
+    while True:
+        # Whoever held the lock before us may have finished the job
+        instance = _reload(model, pk)
+        if instance is None or not needs_lazy_generation(instance):
+            return instance
+        if cache.get(f"{key}:failed"):
+            return None
+
+        if cache.add(key, 1, getattr(settings, "CRYPTPIX_LAZY_LOCK_TIMEOUT", 120)):
+            generated = None
+            try:
+                instance = _reload(model, pk)
+                if instance is None or not needs_lazy_generation(instance):
+                    return instance
+                generated = _generate(instance, cache, key)
+                return generated
+            finally:
+                _release_lock(cache, key, router.db_for_write(model), generated is not None)
+
+        # Another process is generating
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(_POLL_INTERVAL)
+
+
+def ensure_cryptpix_derivatives(instance):
+    """Generate a lazy instance's layers once, however many requests ask at the same time.
+
+    Returns the instance with its layers, the instance unchanged if it does
+    not need lazy generation, or None if generation failed or another
+    process did not finish within CRYPTPIX_LAZY_WAIT.
+    """
+    if not needs_lazy_generation(instance):
+        return instance
+
+    model, pk = type(instance), instance.pk
+    key = f"cryptpix:lazy:{get_model_key(model)}:{pk}"
+    cache = caches[getattr(settings, "CRYPTPIX_LAZY_LOCK_CACHE", "default")]
+    deadline = time.monotonic() + getattr(settings, "CRYPTPIX_LAZY_WAIT", 30)
+
+    entry = _join_local_lock(key)
+    try:
+        lock = entry[0]
+        if not lock.acquire(timeout=max(0, deadline - time.monotonic())):
+            return None
+        try:
+            return _single_flight(model, pk, cache, key, deadline)
+        finally:
+            lock.release()
+    finally:
+        _leave_local_lock(key, entry)
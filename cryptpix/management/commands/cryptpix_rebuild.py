@@ -0,0 +1,307 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import F, Q
+from PIL import Image
+
+from cryptpix.batch import build_cryptpix_layers_batch
+from cryptpix.cache import invalidate_layer_cache, variant_widths
+from cryptpix.core import build_cryptpix_pyramid
+from cryptpix.models import CryptPixBlob
+from cryptpix.utils import get_cryptpix_models
+
+
+def _build_pyramid_worker(source, widths, options):
+    if isinstance(source, bytes):
+        source = Image.open(BytesIO(source))
+    return build_cryptpix_pyramid(source, widths, **options)
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate (or regenerate) CryptPix layers for every CryptPixModelMixin model, "
+        "in keyset-paginated batches on a process pool. Progress is checkpointed so an "
+        "interrupted run resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument(
+            "--only-missing",
+            action="store_true",
+            help=(
+                "Only rows without image_layer_1 (default). Lazy rows that are "
+                "waiting for their first request are left to it."
+            ),
+        )
+        mode.add_argument(
+            "--force",
+            action="store_true",
+            help="Regenerate every row and delete the layers it replaces.",
+        )
+        parser.add_argument(
+            "--model",
+            action="append",
+            dest="models",
+            metavar="APP_LABEL.MODEL",
+            help="Restrict to this model (repeatable).",
+        )
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count() or 1, help="Worker processes."
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default=".cryptpix_rebuild.json",
+            help="Progress file used to resume interrupted runs.",
+        )
+        parser.add_argument(
+            "--reset", action="store_true", help="Ignore and overwrite an existing checkpoint."
+        )
+
+    # Checkpoint ---------------------------------------------------------
+
+    def _load_checkpoint(self, path, reset, run):
+        """Per-model progress of an interrupted run; ``run`` must match the options it had."""
+        if reset or not os.path.exists(path):
+            return {"run": run, "models": {}}
+        with open(path) as fp:
+            checkpoint = json.load(fp)
+        if checkpoint.get("run") != run:
+            # Its rows were selected differently (e.g. --force skipped nothing)
+            raise CommandError(
+                f"{path} belongs to a run with other options ({checkpoint.get('run')}); "
+                "repeat them to resume, or pass --reset to start over."
+            )
+        return checkpoint
+
+    def _write_checkpoint(self, path, state):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(state, fp, indent=2)
+        os.replace(tmp_path, path)
+
+    # Work ---------------------------------------------------------------
+
+    def _selected_models(self, labels):
+        models = get_cryptpix_models()
+        if not labels:
+            return models
+        wanted = {label.lower() for label in labels}
+        selected = [m for m in models if m._meta.label_lower in wanted]
+        unknown = wanted - {m._meta.label_lower for m in selected}
+        if unknown:
+            raise CommandError(f"Not CryptPix models: {', '.join(sorted(unknown))}")
+        return selected
+
+    @staticmethod
+    def _source_for(instance):
+        """A path when the storage has one, otherwise the encoded file bytes."""
+        field = getattr(instance, instance.cryptpix_source_field, None)
+        if not field:
+            return None
+        try:
+            return field.path
+        except NotImplementedError:
+            with field.open("rb") as fp:
+                return fp.read()
+
+    def _process_batch(self, instances, executor, workers):
+        """Generate layers for a batch; returns (updated_instances, update_fields, errors)."""
+        # build_cryptpix_layers options are per row; batch rows with equal options together
+        groups = {}
+        for instance in instances:
+            source = self._source_for(instance)
+            if source is None:
+                continue
+            options = instance.get_cryptpix_generation_options()
+            key = tuple(sorted(options.items(), key=lambda item: item[0]))
+            groups.setdefault(key, []).append((instance, source))
+
+        updated, update_fields, errors = [], set(), 0
+        for key, items in groups.items():
+            results = build_cryptpix_layers_batch(
+                (source for _, source in items),
+                executor=executor,
+                max_workers=workers,
+                **dict(key),
+            )
+            for result in results:
+                instance = items[result.index][0]
+                if not result.ok:
+                    errors += 1
+                    self.stderr.write(
+                        f"  {instance._meta.label} pk={instance.pk}: {result.error!r}"
+                    )
+                    continue
+
+                previous = instance.get_cryptpix_file_names()
+                previous_digest = instance.derivative_digest
+                # Cached variant names are keyed by the widths being replaced
+                replaced_widths = variant_widths(instance.derivative_manifest)
+                try:
+                    update_fields.update(instance.apply_cryptpix_layers(result.layers))
+                except Exception as exc:
+                    errors += 1
+                    self.stderr.write(f"  {instance._meta.label} pk={instance.pk}: {exc!r}")
+                    continue
+
+                instance._cryptpix_previous = previous
+                instance._cryptpix_replaced_widths = replaced_widths
+                if instance._cryptpix_replaced_owned:
+                    instance._cryptpix_replaced = set(previous)
+                    instance._cryptpix_released_digest = ""
+                else:
+                    # Shared layers that other rows still use
+                    instance._cryptpix_replaced = set()
+                    instance._cryptpix_released_digest = previous_digest
+                updated.append(instance)
+
+        # Smaller variants need the full-size hue rotation, so they run second
+        pyramids = {}
+        succeeded = {id(instance) for instance in updated}
+        for items in groups.values():
+            for instance, source in items:
+                if instance.cryptpix_widths and id(instance) in succeeded:
+                    pyramids[instance] = executor.submit(
+                        _build_pyramid_worker,
+                        source,
+                        instance.cryptpix_widths,
+                        instance.get_cryptpix_pyramid_options(),
+                    )
+        for instance, future in pyramids.items():
+            try:
+                update_fields.update(instance.apply_cryptpix_variants(future.result()))
+            except Exception as exc:
+                # Full-size layers are still saved; the previous variants are kept
+                errors += 1
+                self.stderr.write(f"  {instance._meta.label} pk={instance.pk} variants: {exc!r}")
+
+        for instance in updated:
+            current = instance.get_cryptpix_file_names()
+            instance._cryptpix_stored = current - instance._cryptpix_previous
+            instance._cryptpix_replaced -= current
+        return updated, sorted(update_fields), errors
+
+    def _write_batch(self, model, instances, update_fields):
+        """bulk_update a batch, row by row if that fails; returns (written, errors)."""
+        manager = model._default_manager
+        try:
+            manager.bulk_update(instances, update_fields)
+            return instances, 0
+        except Exception:
+            # The batch was rolled back; find the rows that cannot be written
+            pass
+
+        written, errors = [], 0
+        for instance in instances:
+            try:
+                manager.bulk_update([instance], update_fields)
+            except Exception as exc:
+                errors += 1
+                self.stderr.write(f"  {instance._meta.label} pk={instance.pk}: {exc!r}")
+                self._discard_stored(model, instance)
+            else:
+                written.append(instance)
+        return written, errors
+
+    @staticmethod
+    def _discard_stored(model, instance):
+        """Undo the files and blob release of a row that still references its old layers."""
+        for field_name, name in instance._cryptpix_stored:
+            model._meta.get_field(field_name).storage.delete(name)
+        if instance._cryptpix_released_digest:
+            CryptPixBlob.objects.filter(digest=instance._cryptpix_released_digest).update(
+                refcount=F("refcount") + 1
+            )
+
+    @staticmethod
+    def _delete_replaced(model, instances):
+        for instance in instances:
+            for field_name, name in instance._cryptpix_replaced:
+                model._meta.get_field(field_name).storage.delete(name)
+
+    def handle(self, *args, **options):
+        force = options["force"]
+        batch_size = options["batch_size"]
+        workers = max(1, options["workers"])
+        checkpoint_path = options["checkpoint"]
+        models = self._selected_models(options["models"])
+        run = {"force": force, "models": sorted(model._meta.label for model in models)}
+        checkpoint = self._load_checkpoint(checkpoint_path, options["reset"], run)
+
+        # Forked workers must not inherit open database connections, so close
+        # them and start the pool before the first query.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            executor.submit(os.getpid).result()
+
+            for model in models:
+                label = model._meta.label
+                state = checkpoint["models"].setdefault(label, {"last_pk": None, "done": False})
+                if state["done"]:
+                    self.stdout.write(f"{label}: already complete (checkpoint), skipping.")
+                    continue
+
+                queryset = model._default_manager.order_by("pk")
+                if not force:
+                    queryset = queryset.filter(Q(image_layer_1="") | Q(image_layer_1__isnull=True))
+                    if model.cryptpix_generation_mode == "lazy":
+                        # Prepared lazy rows are generated on their first request, with
+                        # the hue rotation pages were already rendered with
+                        queryset = queryset.filter(image_width__isnull=True)
+
+                def remaining():
+                    if state["last_pk"] is None:
+                        return queryset
+                    return queryset.filter(pk__gt=state["last_pk"])
+
+                total = remaining().count()
+                self.stdout.write(f"{label}: {total} row(s) to process.")
+
+                done = failed = 0
+                started = time.monotonic()
+                while True:
+                    instances = list(remaining()[:batch_size])
+                    if not instances:
+                        break
+
+                    updated, update_fields, errors = self._process_batch(
+                        instances, executor, workers
+                    )
+                    if updated:
+                        updated, write_errors = self._write_batch(model, updated, update_fields)
+                        errors += write_errors
+                        for instance in updated:
+                            invalidate_layer_cache(
+                                model, instance.pk, instance._cryptpix_replaced_widths
+                            )
+                        if force:
+                            self._delete_replaced(model, updated)
+
+                    last_pk = instances[-1].pk
+                    state["last_pk"] = last_pk if isinstance(last_pk, int) else str(last_pk)
+                    self._write_checkpoint(checkpoint_path, checkpoint)
+
+                    done += len(instances)
+                    failed += errors
+                    elapsed = time.monotonic() - started
+                    rate = done / elapsed if elapsed else 0.0
+                    eta = (total - done) / rate if rate else 0.0
+                    self.stdout.write(
+                        f"{label}: {done}/{total} ({failed} failed) "
+                        f"{rate:.1f} img/s, ETA {eta:.0f}s"
+                    )
+
+                state["done"] = True
+                self._write_checkpoint(checkpoint_path, checkpoint)
+                self.stdout.write(self.style.SUCCESS(f"{label}: complete ({done} processed, {failed} failed)."))
+
+        # Finished cleanly; the next run starts from scratch.
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cryptpix.tasks import DatabaseQueueBackend
+
+
+class Command(BaseCommand):
+    help = "Drain the CryptPix database job queue (CRYPTPIX_TASK_BACKEND = DatabaseQueueBackend)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", action="store_true", help="Exit when the queue is empty instead of polling."
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=2.0, help="Seconds to wait between polls of an empty queue."
+        )
+        parser.add_argument(
+            "--max-attempts", type=int, default=3, help="Attempts before a failing job is dropped."
+        )
+
+    def handle(self, *args, **options):
+        backend = DatabaseQueueBackend()
+        processed = 0
+
+        while True:
+            job = backend.run_next(max_attempts=options["max_attempts"])
+            if job is not None:
+                processed += 1
+                self.stdout.write(f"Processed {job} (attempt {job.attempts})")
+                continue
+
+            if options["once"]:
+                break
+            time.sleep(options["sleep"])
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {processed} job(s) processed."))
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cryptpix', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CryptPixBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('layer_1', models.CharField(max_length=500)),
+                ('layer_2', models.CharField(blank=True, max_length=500)),
+                ('tile_size', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('image_width', models.PositiveIntegerField()),
+                ('image_height', models.PositiveIntegerField()),
+                ('hue_rotation', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('derivative_manifest', models.JSONField(blank=True, default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
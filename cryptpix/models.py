@@ -0,0 +1,76 @@
+from django.db import models, transaction
+from django.db.models import F
+
+
+class CryptPixJob(models.Model):
+    """A queued derivative-generation job for DatabaseQueueBackend.
+
+    Rows are claimed by ``manage.py cryptpix_worker`` and deleted once the
+    job has run.
+    """
+
+    model_label = models.CharField(max_length=200)
+    object_pk = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        ordering = ["pk"]
+
+    def __str__(self):
+        return f"{self.model_label}:{self.object_pk}"
+
+
+class CryptPixBlob(models.Model):
+    """Shared derivative files for content-addressed deduplication.
+
+    ``digest`` covers the decoded source pixels and the generation
+    parameters (see cryptpix.core.content_digest). Every row of a model with
+    ``cryptpix_deduplicate = True`` whose source hashes to ``digest`` points
+    at these files; ``refcount`` counts those rows, and the files are only
+    deleted when it drops to zero.
+    """
+
+    digest = models.CharField(max_length=64, unique=True)
+    refcount = models.PositiveIntegerField(default=0)
+    layer_1 = models.CharField(max_length=500)
+    layer_2 = models.CharField(max_length=500, blank=True)
+    tile_size = models.PositiveSmallIntegerField(null=True, blank=True)
+    image_width = models.PositiveIntegerField()
+    image_height = models.PositiveIntegerField()
+    hue_rotation = models.PositiveSmallIntegerField(null=True, blank=True)
+    derivative_manifest = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.digest[:16]} ({self.refcount} refs)"
+
+    @classmethod
+    def release(cls, digest: str) -> bool:
+        """Drop one reference to ``digest``.
+
+        Returns True when it was the last one: the blob row is gone and the
+        caller should delete the files. An unknown digest also returns True,
+        since nothing else can be sharing the files.
+        """
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(digest=digest).first()
+            if blob is None:
+                return True
+            if blob.refcount > 1:
+                cls.objects.filter(pk=blob.pk).update(refcount=F("refcount") - 1)
+                return False
+            blob.delete()
+            return True
+
+    def file_names(self) -> set:
+        """(layer field name, storage name) of every file this blob owns."""
+        names = {("image_layer_1", self.layer_1)}
+        if self.layer_2:
+            names.add(("image_layer_2", self.layer_2))
+        for entry in self.derivative_manifest or ():
+            for layer in (1, 2):
+                if entry.get(f"layer_{layer}"):
+                    names.add((f"image_layer_{layer}", entry[f"layer_{layer}"]))
+        return names
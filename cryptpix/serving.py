@@ -0,0 +1,344 @@
+"""How secure_image_view hands file bytes to the client.
+
+Files are streamed through Django, or offloaded to the web server with
+CRYPTPIX_SERVE_BACKEND.
+"""
+
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header, parse_http_date_safe
+
+
+OFFLOAD_HEADERS = {
+    "nginx": "X-Accel-Redirect",
+    "litespeed": "X-LiteSpeed-Location",
+    "apache": "X-Sendfile",
+    "lighttpd": "X-Sendfile",
+}
+
+
+# Requests asking for more ranges than this get the whole file instead
+MAX_RANGES = 16
+
+
+def parse_range_header(header: str, size: int):
+    """
+    Parse a Range header against a file of ``size`` bytes.
+
+    Returns a list of inclusive (start, end) pairs; an empty list when no
+    range is satisfiable (416); or None when the header is malformed, uses
+    another unit or asks for too many ranges (serve the whole file).
+    """
+    units, _, spec = header.partition("=")
+    if units.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0 or size == 0:
+                continue
+            ranges.append((max(0, size - length), size - 1))
+            continue
+
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            continue
+        end = min(int(last), size - 1) if last else size - 1
+        ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def _if_range_matches(request, etag, last_modified) -> bool:
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return etag is not None and if_range == etag
+    since = parse_http_date_safe(if_range)
+    return since is not None and last_modified is not None and last_modified <= since
+
+
+def _read_range(file, start, end, chunk_size):
+    file.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        data = file.read(min(chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def _stream_ranges(file, ranges, size, content_type, boundary, chunk_size):
+    try:
+        if boundary is None:
+            (start, end), = ranges
+            yield from _read_range(file, start, end, chunk_size)
+            return
+        for start, end in ranges:
+            yield _part_header(boundary, content_type, start, end, size)
+            yield from _read_range(file, start, end, chunk_size)
+        yield f"\r\n--{boundary}--\r\n".encode()
+    finally:
+        file.close()
+
+
+def _part_header(boundary, content_type, start, end, size) -> bytes:
+    return (
+        f"\r\n--{boundary}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+    ).encode()
+
+
+def _range_request(request, etag, last_modified):
+    """The Range header to honor for this request, or None to serve the whole file."""
+    if request is None or request.method not in ("GET", "HEAD"):
+        return None
+    header = request.META.get("HTTP_RANGE")
+    if not header or not _if_range_matches(request, etag, last_modified):
+        return None
+    return header
+
+
+def _unsatisfiable(size):
+    response = HttpResponse(status=416)
+    response["Content-Range"] = f"bytes */{size}"
+    return response
+
+
+def _partial_response(body, ranges, size, content_type, boundary):
+    if boundary is None:
+        (start, end), = ranges
+        response = StreamingHttpResponse(body, status=206, content_type=content_type)
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        length = end - start + 1
+    else:
+        response = StreamingHttpResponse(
+            body, status=206, content_type=f"multipart/byteranges; boundary={boundary}"
+        )
+        length = sum(
+            len(_part_header(boundary, content_type, start, end, size)) + end - start + 1
+            for start, end in ranges
+        ) + len(f"\r\n--{boundary}--\r\n")
+    response["Content-Length"] = str(length)
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def _chunk_size():
+    return getattr(settings, "CRYPTPIX_RANGE_CHUNK_SIZE", 64 * 1024)
+
+
+def range_response(request, storage, name, content_type, etag=None, last_modified=None):
+    """
+    A 206/416 response for a Range request, or None to serve the whole file.
+    """
+    header = _range_request(request, etag, last_modified)
+    if header is None:
+        return None
+
+    size = storage.size(name)
+    ranges = parse_range_header(header, size)
+    if ranges is None:
+        return None
+    if not ranges:
+        return _unsatisfiable(size)
+
+    boundary = secrets.token_hex(16) if len(ranges) > 1 else None
+    body = _stream_ranges(storage.open(name, "rb"), ranges, size, content_type, boundary, _chunk_size())
+    return _partial_response(body, ranges, size, content_type, boundary)
+
+
+# Async streaming -------------------------------------------------------
+
+_io_executor = None
+
+
+def to_io_thread(func):
+    """Run storage I/O off the event loop on CryptPix's own thread pool.
+
+    A dedicated pool (CRYPTPIX_ASYNC_IO_THREADS, default 64) keeps slow
+    storage reads from queueing behind the loop's small default executor.
+    """
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, "CRYPTPIX_ASYNC_IO_THREADS", 64),
+            thread_name_prefix="cryptpix-io",
+        )
+    return sync_to_async(func, thread_sensitive=False, executor=_io_executor)
+
+
+def _open_sized(storage, name):
+    file = storage.open(name, "rb")
+    return file, file.size
+
+
+def _read_at(file, offset, size):
+    file.seek(offset)
+    return file.read(size)
+
+
+async def _aread_range(file, start, end, chunk_size):
+    # One thread hop per chunk: seek and read together
+    offset = start
+    while offset <= end:
+        data = await to_io_thread(_read_at)(file, offset, min(chunk_size, end - offset + 1))
+        if not data:
+            break
+        offset += len(data)
+        yield data
+
+
+async def _astream_ranges(file, ranges, size, content_type, boundary, chunk_size):
+    try:
+        if boundary is None:
+            (start, end), = ranges
+            async for data in _aread_range(file, start, end, chunk_size):
+                yield data
+            return
+        for start, end in ranges:
+            yield _part_header(boundary, content_type, start, end, size)
+            async for data in _aread_range(file, start, end, chunk_size):
+                yield data
+        yield f"\r\n--{boundary}--\r\n".encode()
+    finally:
+        file.close()
+
+
+async def _astreamed_response(request, storage, name, content_type, etag, last_modified):
+    file, size = await to_io_thread(_open_sized)(storage, name)
+    header = _range_request(request, etag, last_modified)
+    ranges = parse_range_header(header, size) if header is not None else None
+    if ranges == []:
+        file.close()
+        return _unsatisfiable(size)
+
+    if ranges:
+        boundary = secrets.token_hex(16) if len(ranges) > 1 else None
+        body = _astream_ranges(file, ranges, size, content_type, boundary, _chunk_size())
+        return _partial_response(body, ranges, size, content_type, boundary)
+
+    body = _astream_ranges(file, [(0, size - 1)], size, content_type, None, _chunk_size())
+    response = StreamingHttpResponse(body, content_type=content_type)
+    response["Content-Length"] = str(size)
+    response["Content-Disposition"] = content_disposition_header(False, os.path.basename(name))
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def _internal_url(name: str) -> str:
+    prefix = getattr(settings, "CRYPTPIX_SERVE_INTERNAL_PREFIX", "/protected/")
+    return prefix.rstrip("/") + "/" + quote(name.lstrip("/"))
+
+
+def _streamed_response(request, storage, name, content_type, etag, last_modified):
+    if request is not None:
+        response = range_response(request, storage, name, content_type, etag, last_modified)
+        if response is not None:
+            return response
+    response = FileResponse(storage.open(name, "rb"), content_type=content_type)
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def _offload_response(storage, name, content_type):
+    """The offload response for CRYPTPIX_SERVE_BACKEND, or None to stream through Django."""
+    backend = getattr(settings, "CRYPTPIX_SERVE_BACKEND", None)
+    if backend in (None, "django"):
+        return None
+
+    try:
+        header = OFFLOAD_HEADERS[backend]
+    except KeyError:
+        raise ImproperlyConfigured(f"Unknown CRYPTPIX_SERVE_BACKEND: {backend!r}")
+
+    if header == "X-Sendfile":
+        try:
+            value = storage.path(name)
+        except NotImplementedError:
+            # Remote storage: nothing on disk for the web server to send
+            return None
+    else:
+        value = _internal_url(name)
+
+    response = HttpResponse(content_type=content_type)
+    response[header] = value
+    # Lets OffloadEmulationMiddleware find the file without path mapping
+    response.cryptpix_offload = (storage, name)
+    return response
+
+
+def file_response(storage, name: str, content_type: str, request=None, etag=None, last_modified=None):
+    """A response that delivers ``name`` from ``storage`` per CRYPTPIX_SERVE_BACKEND.
+
+    Pass ``request`` to honor Range headers when streaming through Django;
+    ``etag`` and ``last_modified`` are used to evaluate If-Range.
+    """
+    response = _offload_response(storage, name, content_type)
+    if response is None:
+        response = _streamed_response(request, storage, name, content_type, etag, last_modified)
+    return response
+
+
+async def afile_response(storage, name: str, content_type: str, request=None, etag=None, last_modified=None):
+    """Async ``file_response``: streams through an async iterator, storage I/O off the event loop."""
+    response = _offload_response(storage, name, content_type)
+    if response is None:
+        response = await _astreamed_response(request, storage, name, content_type, etag, last_modified)
+    return response
+
+
+class OffloadEmulationMiddleware:
+    """Stand-in for the web server's offload handling (development/tests only).
+
+    Replaces an offload response from secure_image_view with the file it
+    points at, keeping the caching headers. The original offload header is
+    preserved so tests can assert on it.
+    """
+
+    passthrough_headers = ("ETag", "Last-Modified", "Cache-Control") + tuple(
+        set(OFFLOAD_HEADERS.values())
+    )
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        offload = getattr(response, "cryptpix_offload", None)
+        if offload is None or response.status_code != 200:
+            return response
+
+        storage, name = offload
+        served = FileResponse(storage.open(name, "rb"), content_type=response["Content-Type"])
+        for header in self.passthrough_headers:
+            if header in response:
+                served[header] = response[header]
+        return served
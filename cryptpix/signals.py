@@ -1,26 +1,139 @@
-from django.core.files.storage import default_storage
+"""CryptPix signals, and derivative file cleanup when CryptPix rows are deleted."""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
 from django.db.models.signals import post_delete
-from django.dispatch import receiver
-
-
-# Connect to ANY model that uses CryptPixModelMixin
-@receiver(post_delete)
-def delete_cryptpix_files(sender, instance, **kwargs):
-    """Delete CryptPix derivative files when a model instance is deleted."""
-    try:
-        # Layer 1 (always may exist)
-        if hasattr(instance, "image_layer_1"):
-            f1 = getattr(instance, "image_layer_1", None)
-            name1 = getattr(f1, "name", None)
-            if name1 and default_storage.exists(name1):
-                default_storage.delete(name1)
-
-        # Layer 2 (optional; may be blank when split is disabled)
-        if hasattr(instance, "image_layer_2"):
-            f2 = getattr(instance, "image_layer_2", None)
-            name2 = getattr(f2, "name", None)
-            if name2 and default_storage.exists(name2):
-                default_storage.delete(name2)
-
-    except Exception as e:
-        print("CryptPix error: {}".format(e))
+from django.dispatch import Signal
+
+
+logger = logging.getLogger(__name__)
+
+# sender=model; instance, update_fields, deduplicated, seconds. Sent once the
+# layer files are stored, before the row is saved; deduplicated means shared
+# layers were adopted instead of generated.
+derivatives_generated = Signal()
+# sender=model; request, pk, layer, width, response, cached. Sent by both views
+# for every file response (206/304 included); cached means the layer name came
+# from the name cache rather than the database.
+layer_served = Signal()
+
+
+def _delete_files(items, executor=None):
+    """Delete (storage, name) pairs, concurrently when an executor is given."""
+
+    def delete(storage, name):
+        try:
+            # No exists() first: deleting a missing file is a no-op for the
+            # built-in storages and saves a round trip on remote ones
+            storage.delete(name)
+        except Exception:
+            logger.exception("CryptPix: could not delete %s", name)
+
+    if executor is None:
+        for storage, name in items:
+            delete(storage, name)
+        return
+    wait([executor.submit(delete, storage, name) for storage, name in items])
+
+
+class FileDeleter:
+    """Buffers committed file deletions and runs them in batches."""
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cryptpix-delete")
+        self._coordinator = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cryptpix-cleanup")
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._running = None
+
+    def add(self, items) -> None:
+        with self._lock:
+            self._buffer.extend(items)
+            if self._running is None:
+                self._running = self._coordinator.submit(self._drain)
+
+    def _drain(self) -> None:
+        while True:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+                if not batch:
+                    self._running = None
+                    return
+            _delete_files(batch, self._executor)
+
+    def wait(self) -> None:
+        """Block until everything added so far has been deleted."""
+        while True:
+            with self._lock:
+                running = self._running
+            if running is None:
+                return
+            running.result()
+
+
+_deleter = None
+_deleter_lock = threading.Lock()
+
+
+def _get_deleter():
+    global _deleter
+    with _deleter_lock:
+        if _deleter is None:
+            _deleter = FileDeleter(getattr(settings, "CRYPTPIX_DELETE_WORKERS", 8))
+        return _deleter
+
+
+def _delete_after_commit(items) -> None:
+    if getattr(settings, "CRYPTPIX_DELETE_WORKERS", 8) <= 0:
+        _delete_files(items)
+    else:
+        _get_deleter().add(items)
+
+
+def wait_for_file_deletions() -> None:
+    """Block until committed derivative deletions have finished (tests, scripts)."""
+    if _deleter is not None:
+        _deleter.wait()
+
+
+def _derivative_files(instance):
+    """(storage, name) of every derivative file the instance references."""
+    model = type(instance)
+    return [
+        (model._meta.get_field(field_name).storage, name)
+        for field_name, name in instance.get_cryptpix_file_names()
+    ]
+
+
+def delete_cryptpix_files(sender, instance, using=None, **kwargs):
+    """Delete CryptPix derivative files once the row's deletion commits."""
+    from .cache import invalidate_layer_cache, variant_widths
+
+    invalidate_layer_cache(sender, instance.pk, variant_widths(instance.derivative_manifest))
+
+    # Deduplicated layers: other rows may still reference the files
+    digest = getattr(instance, "derivative_digest", "")
+    if digest:
+        from .models import CryptPixBlob
+
+        if not CryptPixBlob.release(digest):
+            return
+
+    items = _derivative_files(instance)
+    if items:
+        transaction.on_commit(partial(_delete_after_commit, items), using=using)
+
+
+def connect_signals(models) -> None:
+    """Connect the cleanup receiver to each CryptPix model (idempotent)."""
+    for model in models:
+        post_delete.connect(
+            delete_cryptpix_files,
+            sender=model,
+            dispatch_uid=f"cryptpix-delete-files:{model._meta.label_lower}",
+        )
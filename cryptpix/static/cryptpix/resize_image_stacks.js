@@ -1,3 +1,47 @@
+// Geometry of a stack's responsive variants plus the full-size image, narrowest
+// first. Each variant is split with its own tile size.
+function stackVariants(stack) {
+  const tileMeta = stack.querySelector('.tile-meta');
+  const topImg = stack.querySelector('img[data-natural-width][data-natural-height]');
+  if (!tileMeta || !topImg) {
+    return [];
+  }
+  const variants = JSON.parse(tileMeta.dataset.variants || '[]');
+  variants.push({
+    width: parseInt(topImg.getAttribute('data-natural-width'), 10),
+    height: parseInt(topImg.getAttribute('data-natural-height'), 10),
+    tile_size: parseInt(tileMeta.dataset.tileSize, 10),
+  });
+  return variants.sort((a, b) => a.width - b.width);
+}
+
+// The variant a stack shows at cssWidth. Once one layer has loaded a variant
+// the stack sticks to it, so both halves of the checkerboard always match.
+function stackVariant(stack, cssWidth) {
+  const variants = stackVariants(stack);
+  if (!variants.length) {
+    return null;
+  }
+  const chosen = parseInt(stack.dataset.variantWidth, 10);
+  const match = variants.find(v => v.width === chosen);
+  if (match) {
+    return match;
+  }
+  const needed = cssWidth * (window.devicePixelRatio || 1);
+  return variants.find(v => v.width >= needed) || variants[variants.length - 1];
+}
+
+// URL of the "<url> <width>w" candidate in a data-srcset, or null
+function srcsetCandidate(srcset, width) {
+  for (const candidate of srcset.split(',')) {
+    const [url, descriptor] = candidate.trim().split(/\s+/);
+    if (descriptor === `${width}w`) {
+      return url;
+    }
+  }
+  return null;
+}
+
 function resizeImageStacks() {
 
   // Helper function to parse dimension (pixels or percentage)
@@ -109,9 +153,12 @@ function resizeImageStacks() {
       }
     }
 
-    // Quantize dimensions to the nearest tile size multiple
-    const scaledWidth = Math.round(targetWidth / tileSize) * tileSize;
-    const scaledHeight = Math.round(targetHeight / tileSize) * tileSize;
+    // Quantize dimensions to the nearest multiple of the shown variant's tile size
+    stack.dataset.targetWidth = targetWidth;
+    const variant = stackVariant(stack, targetWidth);
+    const quantum = variant ? variant.tile_size : tileSize;
+    const scaledWidth = Math.round(targetWidth / quantum) * quantum;
+    const scaledHeight = Math.round(targetHeight / quantum) * quantum;
     stack.style.width = `${scaledWidth}px`;
     stack.style.height = `${scaledHeight}px`;
   });
@@ -195,8 +242,26 @@ class LazyLoader {
   }
 
   loadImage(img) {
-    const src = img.dataset.src;
-    img.src = src;
+    const stack = img.closest('.image-stack[data-layout="stack"]');
+    if (stack && img.dataset.srcset) {
+      // Stack layers: pick one variant for the whole stack and set src on
+      // each layer from it, rather than letting the browser choose per layer.
+      // The width resizeImageStacks quantized for keeps its tile size valid.
+      const cssWidth = parseFloat(stack.dataset.targetWidth) || stack.getBoundingClientRect().width;
+      const variant = stackVariant(stack, cssWidth || Infinity);
+      if (variant) {
+        stack.dataset.variantWidth = variant.width;
+      }
+      img.src = (variant && srcsetCandidate(img.dataset.srcset, variant.width)) || img.dataset.src;
+    } else {
+      // Responsive variants: sizes must be set before srcset so the browser
+      // picks the right candidate; src stays as the full-size fallback.
+      if (img.dataset.srcset) {
+        img.sizes = img.dataset.sizes || '100vw';
+        img.srcset = img.dataset.srcset;
+      }
+      img.src = img.dataset.src;
+    }
 
     const poll = () => {
       if (img.complete && img.naturalWidth > 0) {
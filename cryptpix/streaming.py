@@ -0,0 +1,181 @@
+"""Memory-bounded derivative generation: tile-aligned strips fed to incremental PNG encoders.
+
+Layer pixels match ``cryptpix.core``; the PNG bytes differ.
+"""
+
+from __future__ import annotations
+
+import random
+import struct
+import zlib
+from io import BytesIO
+from typing import BinaryIO, Optional, Tuple
+
+from PIL import Image, ImageChops
+
+from .core import (
+    DEFAULT_LAYER_ENCODING,
+    LayerEncoding,
+    PILImageOrPath,
+    _checkerboard_mask,
+    _open_image,
+    choose_tile_size,
+    rotate_hue_and_invert,
+)
+
+
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Rough working-set cost of one pixel while a strip is in flight: the
+# crop, the HSV/RGB intermediates, the RGBA strip, the mask, two layer
+# strips and the PNG "Up" filter buffers, at 4 bytes per pixel each.
+_BYTES_PER_STRIP_PIXEL = 48
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_FILTER_UP = b"\x02"
+
+
+class PNGStreamWriter:
+    """Incremental RGBA PNG encoder.
+
+    Rows are appended in strips with ``write``; compressed data is flushed
+    to ``fp`` as IDAT chunks after every strip. Rows use the PNG "Up"
+    filter, computed with ``ImageChops.subtract_modulo`` so no per-pixel
+    Python work is needed.
+    """
+
+    def __init__(self, fp: BinaryIO, width: int, height: int, *, compress_level: int = 6):
+        self.fp = fp
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compress_level)
+        self._previous_row: Optional[Image.Image] = None
+
+        fp.write(_PNG_SIGNATURE)
+        # 8-bit RGBA, deflate, adaptive filtering, no interlace
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+    def _write_chunk(self, chunk_type: bytes, data: bytes) -> None:
+        self.fp.write(struct.pack(">I", len(data)))
+        self.fp.write(chunk_type)
+        self.fp.write(data)
+        self.fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xFFFFFFFF))
+
+    def write(self, strip: Image.Image) -> None:
+        """Append an RGBA strip (full image width, any height)."""
+        if strip.mode != "RGBA" or strip.size[0] != self.width:
+            raise ValueError("strip must be RGBA and span the full image width")
+        strip_height = strip.size[1]
+        if self.rows_written + strip_height > self.height:
+            raise ValueError("more rows written than declared in the PNG header")
+
+        # Row y-1 for every row of the strip; the first row of the image has
+        # an all-zero predecessor, which makes "Up" equivalent to "None".
+        above = Image.new("RGBA", strip.size, (0, 0, 0, 0))
+        if self._previous_row is not None:
+            above.paste(self._previous_row, (0, 0))
+        if strip_height > 1:
+            above.paste(strip.crop((0, 0, self.width, strip_height - 1)), (0, 1))
+        filtered = ImageChops.subtract_modulo(strip, above).tobytes()
+        del above
+
+        stride = self.width * 4
+        raw = _FILTER_UP + _FILTER_UP.join(
+            filtered[offset:offset + stride] for offset in range(0, len(filtered), stride)
+        )
+        del filtered
+
+        data = self._compressor.compress(raw)
+        if data:
+            self._write_chunk(b"IDAT", data)
+
+        self._previous_row = strip.crop((0, strip_height - 1, self.width, strip_height))
+        self.rows_written += strip_height
+
+    def close(self) -> None:
+        if self.rows_written != self.height:
+            raise ValueError(
+                f"PNG declared {self.height} rows but {self.rows_written} were written"
+            )
+        self._write_chunk(b"IDAT", self._compressor.flush())
+        self._write_chunk(b"IEND", b"")
+
+
+def strip_height_for_budget(width: int, block_size: int, memory_budget: int) -> int:
+    """Largest tile-aligned strip height whose working set fits the budget."""
+    rows = memory_budget // max(1, width * _BYTES_PER_STRIP_PIXEL)
+    return max(block_size, rows - rows % block_size)
+
+
+def stream_cryptpix_layers(
+    source: PILImageOrPath,
+    *,
+    use_distortion: bool,
+    use_split: bool,
+    memory_budget: int = DEFAULT_MEMORY_BUDGET,
+    hue_rotation: Optional[int] = None,
+    encoding: Optional[LayerEncoding] = None,
+) -> Tuple[BytesIO, Optional[BytesIO], Optional[int], int, int, Optional[int]]:
+    """Strip-based equivalent of ``cryptpix.core.build_cryptpix_layers``.
+
+    Returns the same tuple contract as ``build_cryptpix_layers``. Only plain
+    PNG output is supported; ``encoding.compress_level`` is honored.
+    """
+    encoding = encoding or DEFAULT_LAYER_ENCODING
+    if encoding.format.upper() != "PNG" or encoding.quantize_colors or encoding.optimize:
+        raise ValueError("Streaming generation only supports PNG output without optimize/quantize")
+
+    img = _open_image(source)
+    full_width, full_height = img.size
+
+    if use_distortion and hue_rotation is None:
+        hue_rotation = random.randint(30, 180)
+    if not use_distortion:
+        hue_rotation = None
+
+    if use_split:
+        block_size = choose_tile_size(full_width, full_height)
+        width = full_width - full_width % block_size
+        height = full_height - full_height % block_size
+    else:
+        block_size = None
+        width, height = full_width, full_height
+
+    strip_height = strip_height_for_budget(width, block_size or 1, memory_budget)
+
+    layer1_io = BytesIO()
+    writer1 = PNGStreamWriter(layer1_io, width, height, compress_level=encoding.compress_level)
+    layer2_io = writer2 = None
+    if use_split:
+        layer2_io = BytesIO()
+        writer2 = PNGStreamWriter(layer2_io, width, height, compress_level=encoding.compress_level)
+
+    for top in range(0, height, strip_height):
+        bottom = min(top + strip_height, height)
+        strip = img.crop((0, top, width, bottom))
+        if use_distortion:
+            strip = rotate_hue_and_invert(strip, hue_rotation)
+        strip = strip.convert("RGBA")
+
+        if not use_split:
+            writer1.write(strip)
+            continue
+
+        # Strips start on a tile boundary; odd tile rows start with layer 2.
+        starts_even = (top // block_size) % 2 == 0
+        for writer, first_layer in ((writer1, True), (writer2, False)):
+            layer = Image.new("RGBA", strip.size, (0, 0, 0, 0))
+            mask = _checkerboard_mask(
+                width, bottom - top, block_size, first_layer=first_layer == starts_even
+            )
+            layer.paste(strip, (0, 0), mask)
+            writer.write(layer)
+
+    writer1.close()
+    layer1_io.seek(0)
+    if writer2 is not None:
+        writer2.close()
+        layer2_io.seek(0)
+
+    return layer1_io, layer2_io, block_size, width, height, hue_rotation
@@ -0,0 +1,163 @@
+"""Background derivative generation for CryptPixModelMixin's deferred mode.
+
+Custom CRYPTPIX_TASK_BACKEND classes implement ``enqueue(model_label, pk)``
+and should end up calling ``generate_derivatives``.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .integrations.django import ProcessingState
+
+
+logger = logging.getLogger(__name__)
+
+
+def _without_layers(queryset):
+    return queryset.filter(Q(image_layer_1="") | Q(image_layer_1__isnull=True))
+
+
+def generate_derivatives(model_label: str, pk, reclaim: bool = False) -> bool:
+    """Generate layers for one pending instance.
+
+    The row is claimed by moving it from pending/failed to processing, so a
+    job that is delivered twice only runs once. With ``reclaim`` a row left
+    in processing without layers is taken over too: the job's previous
+    delivery was abandoned by a dead worker. Returns True when layers were
+    generated.
+    """
+    model = apps.get_model(model_label)
+    claimable = Q(processing_state__in=[ProcessingState.PENDING, ProcessingState.FAILED])
+    if reclaim:
+        claimable |= Q(processing_state=ProcessingState.PROCESSING)
+    claimed = _without_layers(model.objects.filter(claimable, pk=pk)).update(
+        processing_state=ProcessingState.PROCESSING
+    )
+    if not claimed:
+        return False
+
+    try:
+        instance = model.objects.get(pk=pk)
+        update_fields = instance.generate_cryptpix_derivatives()
+        instance.save(update_fields=update_fields)
+    except Exception:
+        logger.exception("CryptPix: derivative generation failed for %s pk=%s", model_label, pk)
+        model.objects.filter(pk=pk).update(processing_state=ProcessingState.FAILED)
+        raise
+    return True
+
+
+def _is_processing(model_label: str, pk) -> bool:
+    """Whether the row is claimed by a generation that has not stored its layers yet."""
+    model = apps.get_model(model_label)
+    return _without_layers(
+        model.objects.filter(pk=pk, processing_state=ProcessingState.PROCESSING)
+    ).exists()
+
+
+class ThreadPoolBackend:
+    """Run generation jobs on a process-local thread pool.
+
+    Queued jobs are lost when the process exits; cryptpix_rebuild generates
+    the rows they leave pending.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, "CRYPTPIX_TASK_THREADS", 2),
+            thread_name_prefix="cryptpix",
+        )
+
+    @staticmethod
+    def _run(model_label, pk):
+        close_old_connections()
+        try:
+            generate_derivatives(model_label, pk)
+        except Exception:
+            pass  # already logged and recorded as failed
+        finally:
+            connection.close()
+
+    def enqueue(self, model_label: str, pk) -> None:
+        self.executor.submit(self._run, model_label, pk)
+
+
+class DatabaseQueueBackend:
+    """Store jobs in the CryptPixJob table for ``manage.py cryptpix_worker``."""
+
+    def enqueue(self, model_label: str, pk) -> None:
+        from .models import CryptPixJob
+
+        CryptPixJob.objects.create(model_label=model_label, object_pk=str(pk))
+
+    @staticmethod
+    def claim(stale_after: timedelta = timedelta(minutes=10)):
+        """Lock and return the oldest runnable job, or None.
+
+        Jobs whose lock is older than ``stale_after`` are considered abandoned
+        by a dead worker and are handed out again.
+        """
+        from .models import CryptPixJob
+
+        now = timezone.now()
+        with transaction.atomic():
+            job = (
+                CryptPixJob.objects.select_for_update(
+                    skip_locked=connection.features.has_select_for_update_skip_locked
+                )
+                .filter(Q(locked_at__isnull=True) | Q(locked_at__lt=now - stale_after))
+                .first()
+            )
+            if job is not None:
+                job.locked_at = now
+                job.attempts += 1
+                job.save(update_fields=["locked_at", "attempts"])
+        return job
+
+    def run_next(self, max_attempts: int = 3):
+        """Run one queued job. Returns the job, or None if the queue is empty."""
+        job = self.claim()
+        if job is None:
+            return None
+
+        try:
+            # A job handed out again may find its row stuck in processing
+            # by the worker that died holding it
+            generated = generate_derivatives(
+                job.model_label, job.object_pk, reclaim=job.attempts > 1
+            )
+        except Exception:
+            if job.attempts < max_attempts:
+                # Release the lock so the job is retried
+                type(job).objects.filter(pk=job.pk).update(locked_at=None)
+                return job
+        else:
+            if (
+                not generated
+                and job.attempts < max_attempts
+                and _is_processing(job.model_label, job.object_pk)
+            ):
+                # Another delivery is generating the row. Keep the lock: if that
+                # worker dies, the job is handed out again once the lock is stale
+                return job
+        job.delete()
+        return job
+
+
+@lru_cache(maxsize=None)
+def get_task_backend():
+    path = getattr(settings, "CRYPTPIX_TASK_BACKEND", "cryptpix.tasks.ThreadPoolBackend")
+    return import_string(path)()
+
+
+def enqueue_derivative_generation(model, pk) -> None:
+    get_task_backend().enqueue(model._meta.label, pk)
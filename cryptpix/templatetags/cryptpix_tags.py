@@ -2,7 +2,12 @@ from django import template
 from django.utils.safestring import mark_safe
 from django.utils.html import escape
 
-from cryptpix.html import get_css, render_image_stack, render_single_image
+from cryptpix.html import (
+    get_css,
+    get_image_fragment,
+    render_image_fragments,
+    render_image_stacks,
+)
 
 import json
 
@@ -25,16 +30,93 @@ def cryptpix_image(parser, token):
         )
 
     photo_var = parser.compile_filter(bits[1])
-    raw_attrs = bits[2:]
+    return CryptPixImageNode(photo_var, _compile_attrs(parser, bits[2:]))
 
+
+@register.tag
+def cryptpix_gallery(parser, token):
+    """
+    {% cryptpix_gallery photos class="thumb" breakpoints='[...]' %}
+
+    Renders every photo exactly as {% cryptpix_image photo ... %} would, in
+    one pass (see cryptpix.html.render_image_stacks).
+    """
+    bits = token.split_contents()
+    tag_name = bits[0]
+
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(
+            f"'{tag_name}' tag requires at least 1 argument: iterable of photo instances"
+        )
+
+    photos_var = parser.compile_filter(bits[1])
+    return CryptPixGalleryNode(photos_var, _compile_attrs(parser, bits[2:]))
+
+
+# Tag attributes that control rendering instead of being passed to the <img>
+CONTROL_ATTRS = ("width", "height", "breakpoints", "data-parent-size", "sizes")
+
+
+def _compile_attrs(parser, raw_attrs):
     attrs = {}
     for bit in raw_attrs:
         if "=" not in bit:
             raise template.TemplateSyntaxError(f"Malformed attribute assignment: {bit}")
         key, val = bit.split("=", 1)
         attrs[key] = parser.compile_filter(val)
+    return attrs
+
+
+def _passthrough_attrs(attrs, context):
+    """The escaped attribute string for everything except the control attrs."""
+    passthrough_attrs = []
+    for key, val in attrs.items():
+        if key not in CONTROL_ATTRS:
+            resolved_val = val.resolve(context)
+            passthrough_attrs.append(f'{key}="{escape(resolved_val)}"')
+    return " ".join(passthrough_attrs)
+
+
+def _resolve_control_attrs(attrs, context):
+    """(width_attr, height_attr, breakpoints, parent_size) from the tag attributes."""
+    width_attr = attrs.get("width")
+    height_attr = attrs.get("height")
+    breakpoints = attrs.get("breakpoints")
+    parent_size = attrs.get("data-parent-size")
+
+    if width_attr:
+        width_attr = width_attr.resolve(context)
+    if height_attr:
+        height_attr = height_attr.resolve(context)
+    if breakpoints:
+        breakpoints = json.loads(breakpoints.resolve(context))
+    if parent_size:
+        parent_size = parent_size.resolve(context)
+    return width_attr, height_attr, breakpoints, parent_size
+
 
-    return CryptPixImageNode(photo_var, attrs)
+def _resolve_sizes(attrs, context):
+    """The srcset ``sizes`` value for photos with variants (default "100vw")."""
+    sizes = attrs.get("sizes")
+    return sizes.resolve(context) if sizes else None
+
+
+def _resolve_control_values(attrs, context):
+    """The resolved CONTROL_ATTRS values in order (None if absent), breakpoints unparsed."""
+    return tuple(attrs[name].resolve(context) if name in attrs else None for name in CONTROL_ATTRS)
+
+
+def _fragment_options(passthrough_attrs_str, control_values):
+    """build_image_fragment keyword arguments for one tag's resolved attributes."""
+    width_attr, height_attr, breakpoints, parent_size, sizes = control_values
+    return {
+        "img_attrs": mark_safe(passthrough_attrs_str),
+        "width_attr": width_attr,
+        "height_attr": height_attr,
+        "breakpoints": json.loads(breakpoints) if breakpoints is not None else None,
+        "parent_size": parent_size,
+        "sizes": sizes,
+    }
 
 
 class CryptPixImageNode(template.Node):
@@ -45,74 +127,54 @@ class CryptPixImageNode(template.Node):
     def render(self, context):
         request = context.get("request")
 
+        # All tag attrs (except the control/meta attrs) get applied to the top image (split)
+        # or to the single image (non-split).
+        passthrough_attrs_str = _passthrough_attrs(self.attrs, context)
+
         try:
             photo = self.photo_var.resolve(context)
+            control_values = _resolve_control_values(self.attrs, context)
 
-            image_id = getattr(photo, "pk", None)
-
-            # New flags (set at save-time, treated as immutable)
-            use_split = bool(getattr(photo, "use_split", False))
-            use_distortion = bool(getattr(photo, "use_distortion", False))
-
-            # Metadata (present/meaningful for split mode; hue_rotation meaningful for distortion)
-            tile_size = getattr(photo, "tile_size", None)
-            width = getattr(photo, "image_width", None)
-            height = getattr(photo, "image_height", None)
-            hue_rotation = getattr(photo, "hue_rotation", None)
-
-            # Allow override via tag attributes
-            width_attr = self.attrs.get("width")
-            height_attr = self.attrs.get("height")
-            breakpoints = self.attrs.get("breakpoints")
-            parent_size = self.attrs.get("data-parent-size")
-
-            if width_attr:
-                width_attr = width_attr.resolve(context)
-            if height_attr:
-                height_attr = height_attr.resolve(context)
-            if breakpoints:
-                breakpoints = json.loads(breakpoints.resolve(context))
-            if parent_size:
-                parent_size = parent_size.resolve(context)
+            # Markup is cached per photo and tag arguments; only the tokens are fresh
+            fragment = get_image_fragment(
+                photo,
+                (passthrough_attrs_str, control_values),
+                lambda: _fragment_options(passthrough_attrs_str, control_values),
+            )
 
         except template.VariableDoesNotExist:
             return "<!-- CryptPix Error: Photo variable does not exist in context -->"
         except Exception as e:
             return f"<!-- CryptPix Error: {str(e)} -->"
 
-        # All tag attrs (except the control/meta attrs above) get applied to the top image (split)
-        # or to the single image (non-split).
-        passthrough_attrs = []
-        for key, val in self.attrs.items():
-            if key not in ["width", "height", "breakpoints", "data-parent-size"]:
-                resolved_val = val.resolve(context)
-                passthrough_attrs.append(f'{key}="{escape(resolved_val)}"')
-        passthrough_attrs_str = " ".join(passthrough_attrs)
-
-        if use_split:
-            return render_image_stack(
-                image_id,
-                request,
-                tile_size,
-                width,
-                height,
-                hue_rotation,
-                use_distortion=use_distortion,
-                top_img_attrs=mark_safe(passthrough_attrs_str),
-                width_attr=width_attr,
-                height_attr=height_attr,
-                breakpoints=breakpoints,
-                parent_size=parent_size,
+        return render_image_fragments([fragment], request)
+
+
+class CryptPixGalleryNode(template.Node):
+    def __init__(self, photos_var, attrs):
+        self.photos_var = photos_var
+        self.attrs = attrs
+
+    def render(self, context):
+        request = context.get("request")
+
+        try:
+            photos = self.photos_var.resolve(context)
+            width_attr, height_attr, breakpoints, parent_size = _resolve_control_attrs(
+                self.attrs, context
             )
+        except template.VariableDoesNotExist:
+            return "<!-- CryptPix Error: Photos variable does not exist in context -->"
+        except Exception as e:
+            return f"<!-- CryptPix Error: {str(e)} -->"
 
-        # Not split: render a single secure derivative (layer 1)
-        return render_single_image(
-            image_id,
+        return render_image_stacks(
+            photos or (),
             request,
-            layer=1,
-            use_distortion=use_distortion,
-            hue_rotation=hue_rotation,
-            img_attrs=mark_safe(passthrough_attrs_str),
-            natural_width=width,
-            natural_height=height,
+            img_attrs=_passthrough_attrs(self.attrs, context),
+            width_attr=width_attr,
+            height_attr=height_attr,
+            breakpoints=breakpoints,
+            parent_size=parent_size,
+            sizes=_resolve_sizes(self.attrs, context),
         )
@@ -0,0 +1,75 @@
+import random
+
+from django.test import SimpleTestCase
+from PIL import Image
+
+from cryptpix.core import (
+    _rotate_hue_and_invert_reference,
+    _split_layers_reference,
+    build_cryptpix_pyramid,
+    crop_to_divisible,
+    rotate_hue_and_invert,
+    split_layers,
+)
+
+
+MODES = ("RGB", "RGBA", "L", "P")
+
+
+def noise_image(mode, size, seed=0):
+    """Deterministic random pixels, so every tile differs from its neighbours."""
+    rng = random.Random(seed)
+    if mode == "P":
+        image = Image.frombytes("P", size, rng.randbytes(size[0] * size[1]))
+        image.putpalette(rng.randbytes(768))
+        return image
+    bands = len(mode)
+    return Image.frombytes(mode, size, rng.randbytes(size[0] * size[1] * bands))
+
+
+class SplitLayersTests(SimpleTestCase):
+    # Neither dimension is a multiple of the tile size
+    SIZES = {12: (61, 37), 24: (100, 75), 48: (203, 130)}
+
+    def test_matches_reference(self):
+        for mode in MODES:
+            for block_size, size in self.SIZES.items():
+                with self.subTest(mode=mode, block_size=block_size):
+                    # As process_and_split_image prepares it
+                    image = crop_to_divisible(noise_image(mode, size).convert("RGBA"), block_size)
+                    layers = split_layers(image, block_size)
+                    expected = _split_layers_reference(image, block_size)
+                    for layer, reference in zip(layers, expected):
+                        self.assertEqual(layer.mode, reference.mode)
+                        self.assertEqual(layer.size, reference.size)
+                        self.assertEqual(layer.tobytes(), reference.tobytes())
+
+
+class RotateHueAndInvertTests(SimpleTestCase):
+    def test_matches_reference(self):
+        for mode in MODES:
+            image = noise_image(mode, (61, 37))
+            for hue_rotation in (0, 30, 97, 180, 359):
+                with self.subTest(mode=mode, hue_rotation=hue_rotation):
+                    result = rotate_hue_and_invert(image, hue_rotation)
+                    reference = _rotate_hue_and_invert_reference(image, hue_rotation)
+                    self.assertEqual(result.mode, reference.mode)
+                    self.assertEqual(result.tobytes(), reference.tobytes())
+
+
+class PyramidMemoryBudgetTests(SimpleTestCase):
+    def test_streamed_variants_match_in_memory_ones(self):
+        source = noise_image("RGB", (400, 300))
+        options = dict(use_distortion=True, use_split=True, hue_rotation=45)
+        # A tiny budget forces several strips per variant
+        streamed = build_cryptpix_pyramid(source, (100, 250), memory_budget=1, **options)
+        expected = build_cryptpix_pyramid(source, (100, 250), **options)
+
+        self.assertEqual([width for width, _ in streamed], [100, 250])
+        for (width, layers), (_, reference) in zip(streamed, expected):
+            with self.subTest(width=width):
+                self.assertEqual(layers[2:], reference[2:])
+                for buffer, reference_buffer in zip(layers[:2], reference[:2]):
+                    self.assertEqual(
+                        Image.open(buffer).tobytes(), Image.open(reference_buffer).tobytes()
+                    )
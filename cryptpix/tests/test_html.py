@@ -0,0 +1,55 @@
+import re
+from types import SimpleNamespace
+
+from django.template import Context, Engine
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from cryptpix.utils import unsign_image_token
+
+
+ENGINE = Engine(libraries={"cryptpix_tags": "cryptpix.templatetags.cryptpix_tags"})
+TEMPLATE = ENGINE.from_string("{% load cryptpix_tags %}{% cryptpix_image photo %}")
+
+
+def duck_photo(**fields):
+    """A photo-like object that is not a model instance."""
+    defaults = dict(
+        pk=7,
+        use_split=True,
+        use_distortion=False,
+        tile_size=12,
+        image_width=120,
+        image_height=96,
+        hue_rotation=None,
+        derivative_manifest=[],
+    )
+    return SimpleNamespace(**{**defaults, **fields})
+
+
+@override_settings(ROOT_URLCONF="cryptpix.urls", CRYPTPIX_TOKEN_BINDING="cookie")
+class ImageTagTests(SimpleTestCase):
+    def render(self, photo):
+        request = RequestFactory().get("/")
+        request._cryptpix_client_cookie_middleware = True
+        html = TEMPLATE.render(Context({"photo": photo, "request": request}))
+        image_ids = [
+            unsign_image_token(token)[0]
+            for token in re.findall(r"/secure-image/([^/]+)/", html)
+        ]
+        return html, image_ids
+
+    def test_duck_typed_photo_uses_legacy_ids(self):
+        html, image_ids = self.render(duck_photo())
+
+        self.assertNotIn("CryptPix Error", html)
+        self.assertEqual(image_ids, ["7_1", "7_2"])
+
+    def test_stack_lists_variant_geometry(self):
+        variant = {"width": 60, "height": 48, "tile_size": 12, "layer_1": "a", "layer_2": "b"}
+        html, image_ids = self.render(duck_photo(derivative_manifest=[variant]))
+
+        self.assertIn(
+            """data-variants='[{"width": 60, "height": 48, "tile_size": 12}]'""", html
+        )
+        # data-src, then the srcset with the full size last, for each layer
+        self.assertEqual(image_ids, ["7_1", "7_1@60", "7_1", "7_2", "7_2@60", "7_2"])
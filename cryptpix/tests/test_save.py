@@ -0,0 +1,227 @@
+import threading
+import time
+from io import BytesIO
+from unittest import mock
+
+from django.core.files.storage import InMemoryStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError, connection, models
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext, isolate_apps
+from PIL import Image
+
+from cryptpix.core import build_cryptpix_layers
+from cryptpix.integrations.django import CryptPixModelMixin, ProcessingState
+from cryptpix.models import CryptPixBlob
+
+
+class LatencyStorage(InMemoryStorage):
+    """In-memory storage where every write takes a while, like a remote bucket."""
+
+    latency = 0.05
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+    saved = []
+
+    @classmethod
+    def reset(cls):
+        cls.active = cls.max_active = 0
+        cls.saved = []
+
+    def _save(self, name, content):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            time.sleep(self.latency)
+            name = super()._save(name, content)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+        cls.saved.append(name)
+        return name
+
+
+def upload(name="photo.png", size=(160, 120)):
+    buffer = BytesIO()
+    Image.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 50).convert("RGB").save(buffer, "PNG")
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+STORAGE_SETTINGS = override_settings(
+    STORAGES={
+        "default": {"BACKEND": "cryptpix.tests.test_save.LatencyStorage"},
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    },
+    CRYPTPIX_UPLOAD_THREADS=4,
+)
+
+
+@STORAGE_SETTINGS
+@isolate_apps("cryptpix")
+class SavePhotoTestCase(TransactionTestCase):
+    """Creates a deduplicating CryptPix model's table for each test."""
+
+    available_apps = ["cryptpix"]
+
+    def setUp(self):
+        class SavePhoto(CryptPixModelMixin):
+            image = models.ImageField(upload_to="src")
+            slug = models.SlugField(unique=True)
+            cryptpix_widths = (64,)
+            cryptpix_deduplicate = True
+
+            class Meta:
+                app_label = "cryptpix"
+
+        self.model = SavePhoto
+        with connection.schema_editor() as editor:
+            editor.create_model(SavePhoto)
+        self.addCleanup(self._drop_table)
+        LatencyStorage.reset()
+
+    def _drop_table(self):
+        with connection.schema_editor() as editor:
+            editor.delete_model(self.model)
+
+
+class SingleInsertSaveTests(SavePhotoTestCase):
+    def test_one_insert_and_concurrent_uploads(self):
+        table = self.model._meta.db_table
+        with CaptureQueriesContext(connection) as queries:
+            photo = self.model(image=upload(), slug="a")
+            photo.save()
+
+        writes = [
+            query["sql"] for query in queries
+            if table in query["sql"] and not query["sql"].startswith("SELECT")
+        ]
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].startswith("INSERT"))
+        self.assertTrue(photo.image_layer_1)
+        self.assertEqual(len(photo.derivative_manifest), 1)
+        # Source, two layers and two variant layers; layer uploads overlap
+        self.assertEqual(len(LatencyStorage.saved), 5)
+        self.assertGreater(LatencyStorage.max_active, 1)
+
+    def test_failed_insert_deletes_stored_files(self):
+        self.model(image=upload(), slug="taken", use_distortion=False).save()
+        CryptPixBlob.objects.all().delete()
+        LatencyStorage.reset()
+
+        photo = self.model(image=upload("other.png", (150, 100)), slug="taken")
+        with self.assertRaises(IntegrityError):
+            photo.save()
+
+        self.assertEqual(len(LatencyStorage.saved), 5)
+        for name in LatencyStorage.saved:
+            self.assertFalse(default_storage.exists(name), name)
+        self.assertFalse(CryptPixBlob.objects.exists())
+        # The upload is back in place, so a corrected save works
+        self.assertFalse(photo.image_layer_1)
+        photo.slug = "free"
+        photo.save()
+        self.assertTrue(default_storage.exists(photo.image.name))
+        self.assertTrue(default_storage.exists(photo.image_layer_1.name))
+
+    def test_failed_insert_releases_shared_layers(self):
+        first = self.model(image=upload(), slug="taken")
+        first.save()
+        self.assertEqual(CryptPixBlob.objects.get().refcount, 1)
+
+        LatencyStorage.reset()
+
+        duplicate = self.model(image=upload(), slug="taken")
+        with self.assertRaises(IntegrityError):
+            duplicate.save()
+
+        self.assertEqual(CryptPixBlob.objects.get().refcount, 1)
+        for field_name, name in first.get_cryptpix_file_names():
+            self.assertTrue(default_storage.exists(name), name)
+        # Only the source was stored: the layers were adopted from the blob
+        self.assertEqual(len(LatencyStorage.saved), 1)
+        self.assertFalse(default_storage.exists(LatencyStorage.saved[0]))
+
+
+class ReplaceSharedLayersTests(SavePhotoTestCase):
+    def single_layer(self, photo):
+        photo.use_split = False
+        with photo.image.open("rb"):
+            return build_cryptpix_layers(photo.image, use_distortion=True, use_split=False)
+
+    def test_keeps_layer_2_other_rows_share(self):
+        first = self.model(image=upload(), slug="a")
+        first.save()
+        second = self.model(image=upload(), slug="b")
+        second.save()
+        shared_layer_2 = second.image_layer_2.name
+        self.assertEqual(shared_layer_2, first.image_layer_2.name)
+
+        update_fields = second.apply_cryptpix_layers(self.single_layer(second))
+
+        self.assertIn("derivative_digest", update_fields)
+        self.assertEqual(second.derivative_digest, "")
+        self.assertFalse(second.image_layer_2)
+        self.assertFalse(second._cryptpix_replaced_owned)
+        self.assertEqual(CryptPixBlob.objects.get().refcount, 1)
+        self.assertTrue(default_storage.exists(shared_layer_2))
+
+    def test_deletes_layer_2_with_the_last_reference(self):
+        photo = self.model(image=upload(), slug="a")
+        photo.save()
+        layer_2 = photo.image_layer_2.name
+
+        photo.apply_cryptpix_layers(self.single_layer(photo))
+
+        self.assertTrue(photo._cryptpix_replaced_owned)
+        self.assertFalse(CryptPixBlob.objects.exists())
+        self.assertFalse(default_storage.exists(layer_2))
+
+
+class ResaveTests(SavePhotoTestCase):
+    def test_cache_invalidated_only_when_files_change(self):
+        self.model(image=upload(), slug="a").save()
+        photo = self.model.objects.get()
+
+        with mock.patch("cryptpix.integrations.django.invalidate_layer_cache") as invalidate:
+            photo.slug = "b"
+            photo.save()
+            invalidate.assert_not_called()
+
+            photo.image = upload("replacement.png")
+            photo.save()
+            invalidate.assert_called_once()
+
+    @mock.patch("cryptpix.tasks.enqueue_derivative_generation")
+    def test_deferred_resave_keeps_generated_fields_without_select(self, enqueue):
+        self.model.cryptpix_generation_mode = "deferred"
+        self.model(image=upload(), slug="a").save()
+        stale = self.model.objects.get()
+        # A worker generates the layers after the instance was loaded
+        self.model.objects.update(image_layer_1="layer.png", processing_state=ProcessingState.READY)
+
+        with CaptureQueriesContext(connection) as queries:
+            stale.slug = "b"
+            stale.save()
+
+        self.assertEqual([query["sql"].split()[0] for query in queries], ["UPDATE"])
+        self.assertEqual(
+            self.model.objects.values_list("slug", "image_layer_1", "processing_state").get(),
+            ("b", "layer.png", ProcessingState.READY),
+        )
+        enqueue.assert_called_once()
+
+    @mock.patch("cryptpix.tasks.enqueue_derivative_generation")
+    def test_deferred_resave_requeues_failed_row(self, enqueue):
+        self.model.cryptpix_generation_mode = "deferred"
+        self.model(image=upload(), slug="a").save()
+        self.model.objects.update(processing_state=ProcessingState.FAILED)
+
+        photo = self.model.objects.get()
+        photo.save()
+
+        self.assertEqual(photo.processing_state, ProcessingState.PENDING)
+        self.assertEqual(self.model.objects.get().processing_state, ProcessingState.PENDING)
+        self.assertEqual(enqueue.call_count, 2)
@@ -0,0 +1,126 @@
+import shutil
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.http import FileResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from cryptpix.serving import OffloadEmulationMiddleware, file_response
+from cryptpix.views import _layer_etag, _layer_response
+
+
+CONTENT = b"\x89PNG layer bytes"
+NAME = "cryptpix/2024/photo one_layer1.png"
+
+
+class RemoteStorage(Storage):
+    """A read-only storage without local paths, like S3."""
+
+    def __init__(self, files):
+        self.files = files
+
+    def _open(self, name, mode="rb"):
+        return ContentFile(self.files[name], name=name)
+
+
+class OffloadTestCase(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.storage = FileSystemStorage(location=self.root)
+        self.name = self.storage.save(NAME, ContentFile(CONTENT))
+        self.request = RequestFactory().get("/secure-image/token/")
+
+
+class OffloadHeaderTests(OffloadTestCase):
+    def assertOffloaded(self, response, header, value):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response[header], value)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response.content, b"")
+
+    @override_settings(CRYPTPIX_SERVE_BACKEND="nginx")
+    def test_nginx_maps_name_under_internal_prefix(self):
+        response = file_response(self.storage, self.name, "image/png")
+        self.assertOffloaded(
+            response, "X-Accel-Redirect", "/protected/cryptpix/2024/photo%20one_layer1.png"
+        )
+
+    @override_settings(CRYPTPIX_SERVE_BACKEND="litespeed", CRYPTPIX_SERVE_INTERNAL_PREFIX="/internal")
+    def test_litespeed_uses_configured_prefix(self):
+        response = file_response(self.storage, self.name, "image/png")
+        self.assertOffloaded(
+            response, "X-LiteSpeed-Location", "/internal/cryptpix/2024/photo%20one_layer1.png"
+        )
+
+    def test_sendfile_uses_filesystem_path(self):
+        for backend in ("apache", "lighttpd"):
+            with self.subTest(backend=backend), override_settings(CRYPTPIX_SERVE_BACKEND=backend):
+                response = file_response(self.storage, self.name, "image/png")
+                self.assertOffloaded(response, "X-Sendfile", self.storage.path(self.name))
+
+    @override_settings(CRYPTPIX_SERVE_BACKEND="apache")
+    def test_sendfile_streams_from_storage_without_paths(self):
+        response = file_response(RemoteStorage({NAME: CONTENT}), NAME, "image/png")
+        self.assertIsInstance(response, FileResponse)
+        self.assertNotIn("X-Sendfile", response)
+        self.assertEqual(b"".join(response.streaming_content), CONTENT)
+
+    @override_settings(CRYPTPIX_SERVE_BACKEND="caddy")
+    def test_unknown_backend_is_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            file_response(self.storage, self.name, "image/png")
+
+
+class DjangoStreamingTests(OffloadTestCase):
+    def test_streams_when_backend_unset_or_django(self):
+        for backend in (None, "django"):
+            with self.subTest(backend=backend), override_settings(CRYPTPIX_SERVE_BACKEND=backend):
+                response = file_response(self.storage, self.name, "image/png", self.request)
+                self.assertIsInstance(response, FileResponse)
+                for header in ("X-Accel-Redirect", "X-LiteSpeed-Location", "X-Sendfile"):
+                    self.assertNotIn(header, response)
+                self.assertEqual(response["Accept-Ranges"], "bytes")
+                self.assertEqual(b"".join(response.streaming_content), CONTENT)
+
+
+@override_settings(CRYPTPIX_CACHE_MAX_AGE=600)
+class OffloadCachingHeaderTests(OffloadTestCase):
+    def test_validators_and_cache_control_on_offloaded_responses(self):
+        for backend in ("nginx", "litespeed", "apache"):
+            with self.subTest(backend=backend), override_settings(CRYPTPIX_SERVE_BACKEND=backend):
+                response = _layer_response(
+                    self.request, self.storage, self.name, "image/png", 1_700_000_000
+                )
+                self.assertEqual(response.content, b"")
+                self.assertEqual(response["ETag"], _layer_etag(self.name))
+                self.assertEqual(response["Last-Modified"], "Tue, 14 Nov 2023 22:13:20 GMT")
+                self.assertIn("private", response["Cache-Control"])
+                self.assertIn("max-age=600", response["Cache-Control"])
+
+
+@override_settings(CRYPTPIX_SERVE_BACKEND="nginx", CRYPTPIX_CACHE_MAX_AGE=600)
+class OffloadEmulationMiddlewareTests(OffloadTestCase):
+    def test_sends_file_and_keeps_headers(self):
+        offloaded = _layer_response(self.request, self.storage, self.name, "image/png", None)
+        response = OffloadEmulationMiddleware(lambda request: offloaded)(self.request)
+
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(b"".join(response.streaming_content), CONTENT)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response["ETag"], offloaded["ETag"])
+        self.assertEqual(response["Cache-Control"], offloaded["Cache-Control"])
+        self.assertEqual(response["X-Accel-Redirect"], offloaded["X-Accel-Redirect"])
+
+    def test_leaves_other_responses_alone(self):
+        not_modified = _layer_response(
+            RequestFactory().get("/", HTTP_IF_NONE_MATCH=_layer_etag(self.name)),
+            self.storage,
+            self.name,
+            "image/png",
+            None,
+        )
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertIs(OffloadEmulationMiddleware(lambda request: not_modified)(self.request), not_modified)
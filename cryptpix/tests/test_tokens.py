@@ -0,0 +1,86 @@
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from cryptpix.binding import ClientCookieMiddleware, get_binding_key
+
+from cryptpix.utils import sign_image_token, signer, unsign_image_token
+from cryptpix.views import TOKEN_MAX_AGE
+
+
+BUCKET = 600
+# A bucket boundary: a multiple of BUCKET
+BOUNDARY = 1_700_000_400
+
+
+def at(timestamp):
+    """Run as if time.time() returned ``timestamp`` (signing and verification)."""
+    return mock.patch("time.time", return_value=timestamp)
+
+
+@override_settings(CRYPTPIX_TOKEN_BUCKET=BUCKET)
+class TokenBucketTests(SimpleTestCase):
+    def sign(self, timestamp):
+        with at(timestamp):
+            return sign_image_token("1a2b3c4d.1_1", "session")
+
+    def unsign(self, token, timestamp):
+        with at(timestamp):
+            return unsign_image_token(token, max_age=TOKEN_MAX_AGE)
+
+    def test_same_bucket_gives_same_token(self):
+        first = self.sign(BOUNDARY)
+        self.assertEqual(self.sign(BOUNDARY + 1), first)
+        self.assertEqual(self.sign(BOUNDARY + BUCKET - 1), first)
+        self.assertNotEqual(self.sign(BOUNDARY + BUCKET), first)
+
+    def test_token_issued_before_boundary_lasts_max_age(self):
+        issued = BOUNDARY - 1
+        token = self.sign(issued)
+        self.assertEqual(self.unsign(token, issued + TOKEN_MAX_AGE), ("1a2b3c4d.1_1", "session"))
+
+    def test_token_expires_after_max_age_and_bucket(self):
+        bucket_start = BOUNDARY - BUCKET
+        token = self.sign(BOUNDARY - 1)
+        self.assertEqual(
+            self.unsign(token, bucket_start + TOKEN_MAX_AGE + BUCKET), ("1a2b3c4d.1_1", "session")
+        )
+        self.assertEqual(
+            self.unsign(token, bucket_start + TOKEN_MAX_AGE + BUCKET + 1), (None, None)
+        )
+
+    @override_settings(CRYPTPIX_TOKEN_BUCKET=None)
+    def test_without_bucket_tokens_expire_after_max_age(self):
+        token = self.sign(BOUNDARY - 1)
+        self.assertEqual(self.unsign(token, BOUNDARY - 1 + TOKEN_MAX_AGE)[0], "1a2b3c4d.1_1")
+        self.assertEqual(self.unsign(token, BOUNDARY + TOKEN_MAX_AGE), (None, None))
+
+
+class TokenValueTests(SimpleTestCase):
+    def test_image_id_may_contain_colon(self):
+        token = sign_image_token("1a2b3c4d.x:y_1", "session")
+        self.assertEqual(unsign_image_token(token), ("1a2b3c4d.x:y_1", "session"))
+
+    def test_value_without_separator_is_rejected(self):
+        self.assertEqual(unsign_image_token(signer.sign("no-separator")), (None, None))
+
+
+@override_settings(CRYPTPIX_TOKEN_BINDING="cookie")
+class CookieBindingTests(SimpleTestCase):
+    def test_without_middleware_is_improperly_configured(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_binding_key(RequestFactory().get("/"))
+
+    def test_middleware_sets_the_cookie_for_a_new_key(self):
+        keys = []
+
+        def view(request):
+            keys.append(get_binding_key(request))
+            return HttpResponse()
+
+        response = ClientCookieMiddleware(view)(RequestFactory().get("/"))
+        cookie = response.cookies["cryptpix_client"].value
+        request = RequestFactory().get("/", HTTP_COOKIE=f"cryptpix_client={cookie}")
+        self.assertEqual(get_binding_key(request, create=False), keys[0])
@@ -1,6 +1,7 @@
 from django.urls import path
-from .views import secure_image_view
+from .views import async_secure_image_view, secure_image_view
 
 urlpatterns = [
     path('secure-image/<str:signed_value>/', secure_image_view, name='secure-image'),
+    path('secure-image-async/<str:signed_value>/', async_secure_image_view, name='secure-image-async'),
 ]
@@ -1,28 +1,108 @@
-from django.core.signing import TimestampSigner
+import hashlib
+import time
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signing import TimestampSigner, b62_encode
 
-signer = TimestampSigner()
+
+# Token timestamps ---------------------------------------------------------
+#
+# With CRYPTPIX_TOKEN_BUCKET (seconds) set, tokens carry the start of the
+# current time bucket instead of the current second. The signature then only
+# changes once per bucket, so every render of the same layer for the same
+# session within a bucket yields the same URL and browsers/CDNs can reuse the
+# cached bytes. Verification allows one extra bucket on top of max_age, so a
+# token issued at the very end of a bucket still lives at least max_age.
+
+def _token_bucket() -> int:
+    return getattr(settings, "CRYPTPIX_TOKEN_BUCKET", None) or 0
+
+def _token_timestamp(now=None) -> str:
+    now = int(time.time() if now is None else now)
+    bucket = _token_bucket()
+    if bucket:
+        now -= now % bucket
+    return b62_encode(now)
+
+class _BucketedSigner(TimestampSigner):
+    """TimestampSigner stamping values with the start of the token bucket."""
+
+    def timestamp(self):
+        return _token_timestamp()
+
+signer = _BucketedSigner()
 
 def sign_image_token(image_id, session_key):
-    value = f"{image_id}:{session_key}"
-    return signer.sign(value)
+    return sign_image_tokens([image_id], session_key)[0]
+
+def sign_image_tokens(image_ids, session_key):
+    """sign_image_token for many ids at once."""
+    return [signer.sign(f"{image_id}:{session_key}") for image_id in image_ids]
 
 def unsign_image_token(signed_value, max_age=300):
-    # 5 minutes default expiry
+    # 5 minutes default expiry (plus one bucket with CRYPTPIX_TOKEN_BUCKET)
     from django.core.signing import SignatureExpired, BadSignature
     try:
-        value = signer.unsign(signed_value, max_age=max_age)
-        image_id, session_key = value.split(":")
+        value = signer.unsign(signed_value, max_age=max_age + _token_bucket())
+        image_id, session_key = value.rsplit(":", 1)
         return image_id, session_key
-    except (SignatureExpired, BadSignature):
+    except (SignatureExpired, BadSignature, ValueError):
         return None, None
 
 
-def get_cryptpix_models():
+# Model registry ---------------------------------------------------------
+#
+# Image ids embed a short, stable key for the model ("{model_key}.{pk}"), so
+# secure_image_view can go straight to the right table. The registry is built
+# once (at app ready) instead of scanning apps.get_models() per request.
+
+_registry = None
+
+
+def get_model_key(model) -> str:
+    """Short, stable identifier for a model (8 hex chars of its label hash)."""
+    return hashlib.blake2s(model._meta.label_lower.encode(), digest_size=4).hexdigest()
+
+
+def build_cryptpix_registry():
+    """(Re)build the model-key → model registry of CryptPix models."""
+    global _registry
     from django.apps import apps
     from .integrations.django import CryptPixModelMixin
-    models = []
+
+    registry = {}
     for model in apps.get_models():
         if issubclass(model, CryptPixModelMixin) and model is not CryptPixModelMixin:
-            models.append(model)
-    return models
+            key = get_model_key(model)
+            if key in registry:
+                raise ImproperlyConfigured(
+                    f"CryptPix model key collision between {registry[key]._meta.label} "
+                    f"and {model._meta.label}; rename one of the models."
+                )
+            registry[key] = model
+    _registry = registry
+    return registry
+
+
+def get_cryptpix_registry():
+    if _registry is None:
+        return build_cryptpix_registry()
+    return _registry
+
+
+def get_cryptpix_models():
+    return list(get_cryptpix_registry().values())
+
+
+def get_cryptpix_model(model_key):
+    """The CryptPix model for a key from get_model_key(), or None."""
+    return get_cryptpix_registry().get(model_key)
+
+
+def get_image_ref(instance) -> str:
+    """Image id prefix for an instance: "{model_key}.{pk}".
+
+    Append "_{layer}" to build the image id passed to get_secure_image_url.
+    """
+    return f"{get_model_key(type(instance))}.{instance.pk}"
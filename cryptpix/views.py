@@ -1,8 +1,30 @@
+import hashlib
 import mimetypes
 
-from django.http import FileResponse, HttpResponseForbidden, HttpResponseNotFound
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 
-from .utils import unsign_image_token, get_cryptpix_models
+from .binding import get_binding_key
+from .cache import (
+    aget_layer_entry,
+    aset_layer_entry,
+    get_layer_entry,
+    invalidate_layer_cache,
+    set_layer_entry,
+)
+from .instrumentation import stage
+from .lazy import ensure_cryptpix_derivatives, needs_lazy_generation
+from .serving import afile_response, file_response, to_io_thread
+from .signals import layer_served
+from .utils import unsign_image_token, get_cryptpix_model, get_cryptpix_models
+
+
+# Signed image links are valid for this many seconds
+TOKEN_MAX_AGE = 1200
 
 
 def _guess_content_type(file_field) -> str:
@@ -15,56 +37,318 @@ def _guess_content_type(file_field) -> str:
     return content_type or "application/octet-stream"
 
 
+def _parse_image_id(image_id):
+    """
+    Split an image id into (model_key, pk_str, layer, width).
+
+    Accepted formats:
+      - "{model_key}.{pk}_{layer}" (e.g. "1a2b3c4d.123_1"), see utils.get_image_ref
+      - "{model_key}.{pk}_{layer}@{width}" for a downscaled variant (derivative_manifest)
+      - "{pk}_{layer}" (legacy; model_key is None)
+
+    width is None for the full-size layer.
+    """
+    ref, sep, layer_str = image_id.rpartition("_")
+    if not sep or not ref:
+        raise ValueError("Invalid image_id format")
+    layer_str, at, width_str = layer_str.partition("@")
+    layer = int(layer_str)
+    width = int(width_str) if at else None
+
+    model_key, dot, pk_str = ref.partition(".")
+    if not dot:
+        return None, ref, layer, width
+    return model_key, pk_str, layer, width
+
+
+def _layer_cache_key(layer, width):
+    return layer if width is None else f"{layer}@{width}"
+
+
+def _get_layer_file(instance, layer, width=None):
+    """The FieldFile to serve for a layer, or None if it is not servable."""
+    # Downscaled variants of layers 1/2
+    if width is not None:
+        if layer not in (1, 2) or (layer == 2 and not getattr(instance, "use_split", False)):
+            return None
+        return instance.get_cryptpix_variant_file(layer, width)
+
+    # Layer 0: original source image field
+    if layer == 0:
+        return getattr(instance, instance.cryptpix_source_field, None) or None
+
+    # Layer 1: always served from image_layer_1 (exists for all processed variants)
+    if layer == 1:
+        return instance.image_layer_1 or None
+
+    # Layer 2: only valid/servable when split is enabled
+    if layer == 2 and getattr(instance, "use_split", False):
+        return instance.image_layer_2 or None
+
+    return None
+
+
+def _get_layer_storage(model, layer):
+    field_name = model.cryptpix_source_field if layer == 0 else f"image_layer_{layer}"
+    return model._meta.get_field(field_name).storage
+
+
+def _last_modified(storage, name):
+    """Modification time as a Unix timestamp, or None if the storage can't tell."""
+    try:
+        return int(storage.get_modified_time(name).timestamp())
+    except (NotImplementedError, OSError):
+        return None
+
+
+def _layer_etag(name) -> str:
+    # Stored layers are immutable, so the storage name identifies the bytes
+    return '"%s"' % hashlib.blake2s(name.encode(), digest_size=16).hexdigest()
+
+
+def _finalize_layer_response(response, etag, last_modified):
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+
+    max_age = getattr(settings, "CRYPTPIX_CACHE_MAX_AGE", TOKEN_MAX_AGE)
+    if max_age:
+        patch_cache_control(response, private=True, max_age=max_age)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _layer_response(request, storage, name, content_type, last_modified):
+    """Serve a stored file with validators, answering conditional requests with 304."""
+    etag = _layer_etag(name)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = file_response(storage, name, content_type, request, etag, last_modified)
+    return _finalize_layer_response(response, etag, last_modified)
+
+
+async def _alayer_response(request, storage, name, content_type, last_modified):
+    etag = _layer_etag(name)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = await afile_response(storage, name, content_type, request, etag, last_modified)
+    return _finalize_layer_response(response, etag, last_modified)
+
+
+def _serve_cached(request, model, model_key, pk_str, layer, width=None):
+    """Serve a layer straight from storage using the name cache (no DB query)."""
+    entry = get_layer_entry(model_key, pk_str, _layer_cache_key(layer, width))
+    if entry is None:
+        return None
+    name, content_type, last_modified = entry
+    try:
+        return _layer_response(
+            request, _get_layer_storage(model, layer), name, content_type, last_modified
+        )
+    except FileNotFoundError:
+        # Stale entry (e.g. deleted in another process); fall back to the DB
+        invalidate_layer_cache(model, pk_str, () if width is None else (width,))
+        return None
+
+
+async def _aserve_cached(request, model, model_key, pk_str, layer, width=None):
+    entry = await aget_layer_entry(model_key, pk_str, _layer_cache_key(layer, width))
+    if entry is None:
+        return None
+    name, content_type, last_modified = entry
+    try:
+        return await _alayer_response(
+            request, _get_layer_storage(model, layer), name, content_type, last_modified
+        )
+    except FileNotFoundError:
+        await to_io_thread(invalidate_layer_cache)(
+            model, pk_str, () if width is None else (width,)
+        )
+        return None
+
+
+def _serve_field(request, image_field):
+    storage, name = image_field.storage, image_field.name
+    return _layer_response(
+        request, storage, name, _guess_content_type(image_field), _last_modified(storage, name)
+    )
+
+
+def _generation_unavailable():
+    # Lazy generation failed or is still running elsewhere
+    response = HttpResponse("Image is not available yet.", status=503, content_type="text/plain")
+    response["Retry-After"] = "2"
+    return response
+
+
+def _ensure_in_worker(instance):
+    # Runs on a to_io_thread worker, which has its own database connection
+    close_old_connections()
+    try:
+        return ensure_cryptpix_derivatives(instance)
+    finally:
+        close_old_connections()
+
+
+def _check_token(request, signed_value):
+    """The image id of a valid token for this client (session or cookie), or None."""
+    image_id, signed_key = unsign_image_token(signed_value, max_age=TOKEN_MAX_AGE)
+    if image_id is None or signed_key != get_binding_key(request, create=False):
+        return None
+    return image_id
+
+
+def _served(request, model, pk_str, layer, width, response, cached):
+    layer_served.send(
+        sender=model, request=request, pk=pk_str, layer=layer, width=width,
+        response=response, cached=cached,
+    )
+    return response
+
+
+async def _aserved(request, model, pk_str, layer, width, response, cached):
+    await layer_served.asend(
+        sender=model, request=request, pk=pk_str, layer=layer, width=width,
+        response=response, cached=cached,
+    )
+    return response
+
+
 def secure_image_view(request, signed_value):
-    image_id, signed_session_key = unsign_image_token(signed_value, max_age=1200)
+    with stage("serve") as timing:
+        response = _secure_image_response(request, signed_value)
+        timing.record(status=response.status_code)
+    return response
+
 
-    if image_id is None or signed_session_key != request.session.session_key:
+def _secure_image_response(request, signed_value):
+    image_id = _check_token(request, signed_value)
+    if image_id is None:
         return HttpResponseForbidden("Invalid or expired link.")
 
-    # image_id format: "{pk}_{layer}" (e.g. "123_1")
     try:
-        pk_layer = image_id.split("_")
-        if len(pk_layer) != 2:
-            raise ValueError("Invalid image_id format")
+        model_key, pk_str, layer, width = _parse_image_id(image_id)
 
-        pk_str, layer_str = pk_layer
-        pk = int(pk_str)
-        layer = int(layer_str)
+        if model_key is not None:
+            # One model, one indexed lookup
+            model = get_cryptpix_model(model_key)
+            if model is None:
+                return HttpResponseNotFound("Image not found.")
+
+            response = _serve_cached(request, model, model_key, pk_str, layer, width)
+            if response is not None:
+                return _served(request, model, pk_str, layer, width, response, True)
+
+            pk = model._meta.pk.to_python(pk_str)
+            with stage("lookup", model=model._meta.label):
+                instance = model._default_manager.filter(pk=pk).first()
+            if instance is not None and layer != 0 and needs_lazy_generation(instance):
+                instance = ensure_cryptpix_derivatives(instance)
+                if instance is None:
+                    return _generation_unavailable()
+            image_field = _get_layer_file(instance, layer, width) if instance is not None else None
+            if image_field:
+                storage, name = image_field.storage, image_field.name
+                content_type = _guess_content_type(image_field)
+                last_modified = _last_modified(storage, name)
+                set_layer_entry(
+                    model_key, pk_str, _layer_cache_key(layer, width), name, content_type, last_modified
+                )
+                response = _layer_response(request, storage, name, content_type, last_modified)
+                return _served(request, model, pk_str, layer, width, response, False)
+            return HttpResponseNotFound("Image not found.")
 
+        # Legacy ids without a model key: try each CryptPix model in turn
+        pk = int(pk_str)
         for model in get_cryptpix_models():
             try:
                 instance = model.objects.get(pk=pk)
+            except model.DoesNotExist:
+                continue
 
-                # Layer 0: original source image field
-                if layer == 0:
-                    field_name = instance.cryptpix_source_field
-                    image_field = getattr(instance, field_name, None)
-                    if image_field:
-                        return FileResponse(
-                            image_field.open("rb"),
-                            content_type=_guess_content_type(image_field),
-                        )
-
-                # Layer 1: always served from image_layer_1 (exists for all processed variants)
-                if layer == 1 and instance.image_layer_1:
-                    return FileResponse(
-                        instance.image_layer_1.open("rb"),
-                        content_type=_guess_content_type(instance.image_layer_1),
-                    )
-
-                # Layer 2: only valid/servable when split is enabled
-                if layer == 2:
-                    if getattr(instance, "use_split", False) and instance.image_layer_2:
-                        return FileResponse(
-                            instance.image_layer_2.open("rb"),
-                            content_type=_guess_content_type(instance.image_layer_2),
-                        )
-                    return HttpResponseNotFound("Image not found.")
+            image_field = _get_layer_file(instance, layer)
+            if image_field:
+                return _served(
+                    request, model, pk_str, layer, None, _serve_field(request, image_field), False
+                )
+            if layer == 2:
+                return HttpResponseNotFound("Image not found.")
 
-            except model.DoesNotExist:
+    except (ValueError, AttributeError, TypeError, ValidationError):
+        pass
+
+    return HttpResponseNotFound("Image not found.")
+
+
+async def async_secure_image_view(request, signed_value):
+    """
+    Native async ``secure_image_view`` for ASGI deployments.
+
+    Token checks are pure CPU work, instances come from the async ORM and
+    file bodies are streamed through an async iterator, so concurrent layer
+    requests are not bounded by the sync_to_async thread pool.
+    """
+    with stage("serve") as timing:
+        response = await _async_secure_image_response(request, signed_value)
+        timing.record(status=response.status_code)
+    return response
+
+
+async def _async_secure_image_response(request, signed_value):
+    image_id = _check_token(request, signed_value)
+    if image_id is None:
+        return HttpResponseForbidden("Invalid or expired link.")
+
+    try:
+        model_key, pk_str, layer, width = _parse_image_id(image_id)
+
+        if model_key is not None:
+            model = get_cryptpix_model(model_key)
+            if model is None:
+                return HttpResponseNotFound("Image not found.")
+
+            response = await _aserve_cached(request, model, model_key, pk_str, layer, width)
+            if response is not None:
+                return await _aserved(request, model, pk_str, layer, width, response, True)
+
+            pk = model._meta.pk.to_python(pk_str)
+            with stage("lookup", model=model._meta.label):
+                instance = await model._default_manager.filter(pk=pk).afirst()
+            if instance is not None and layer != 0 and needs_lazy_generation(instance):
+                instance = await to_io_thread(_ensure_in_worker)(instance)
+                if instance is None:
+                    return _generation_unavailable()
+            image_field = _get_layer_file(instance, layer, width) if instance is not None else None
+            if image_field:
+                storage, name = image_field.storage, image_field.name
+                content_type = _guess_content_type(image_field)
+                last_modified = await to_io_thread(_last_modified)(storage, name)
+                await aset_layer_entry(
+                    model_key, pk_str, _layer_cache_key(layer, width), name, content_type, last_modified
+                )
+                response = await _alayer_response(request, storage, name, content_type, last_modified)
+                return await _aserved(request, model, pk_str, layer, width, response, False)
+            return HttpResponseNotFound("Image not found.")
+
+        pk = int(pk_str)
+        for model in get_cryptpix_models():
+            instance = await model.objects.filter(pk=pk).afirst()
+            if instance is None:
                 continue
 
-    except (ValueError, AttributeError, TypeError):
+            image_field = _get_layer_file(instance, layer)
+            if image_field:
+                storage, name = image_field.storage, image_field.name
+                last_modified = await to_io_thread(_last_modified)(storage, name)
+                response = await _alayer_response(
+                    request, storage, name, _guess_content_type(image_field), last_modified
+                )
+                return await _aserved(request, model, pk_str, layer, None, response, False)
+            if layer == 2:
+                return HttpResponseNotFound("Image not found.")
+
+    except (ValueError, AttributeError, TypeError, ValidationError):
         pass
 
     return HttpResponseNotFound("Image not found.")